@@ -0,0 +1,247 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+
+from aiogram import Bot
+
+from broadcast import Broadcaster
+from directory import PlateDirectorySync
+from himera import HimeraClient
+from keyboards import dialog_keyboard, main_menu
+from locks import KeyedLock
+from metrics import MetricsRegistry, MetricsServer
+from middlewares import HandlerTimingMiddleware, InflightMiddleware
+from outbound import OutboundQueue
+from repository import UsersRepository
+from scheduler import DeadlineScheduler
+from sessions import DIALOG_STEPS, PENDING_SHUTDOWNS, USER_STATES, SessionStore
+from settings import Settings
+from stats import LatencyStats
+from storage import create_storage
+from support import SUPPORT_TICKETS, SupportDesk
+from throttle import SlidingWindowLimiter, parse_limit
+from writebehind import UpsertBatcher
+
+# Сколько собеседник может думать над запросом на завершение диалога
+SHUTDOWN_CONFIRMATION_TIMEOUT = timedelta(minutes=3)
+# Сколько поиск ждёт, пока владелец найденного авто закончит обработку своего обновления
+DIALOG_CLAIM_TIMEOUT = 1.0
+
+
+def format_broadcast(job: dict):
+    return f"отправлено {job['sent']}, заблокировали бота {job['blocked']}, ошибок {job['failed']}, последний id {job['cursor']}"
+
+
+class App:
+    # Компоненты бота: репозиторий, клиенты, очередь отправки, сессии, таймеры и метрики.
+    # Конструктор только создаёт объекты: клиент Supabase, HTTP-пулы и фоновые задачи
+    # запускаются в on_startup и останавливаются в on_shutdown. Каждый экземпляр независим,
+    # поэтому тесты и воркеры могут собрать своё приложение (см. main.create_app)
+    def __init__(self, settings: Settings):
+        self.settings = settings
+        # Клиент Supabase создаётся в on_startup (см. UsersRepository.connect)
+        self.users_repo = UsersRepository(
+            max_workers=settings.supabase_max_workers, cache_size=settings.user_cache_size, cache_ttl=settings.user_cache_ttl
+        )
+        self.plate_directory = PlateDirectorySync(
+            self.users_repo, settings.plate_sync_interval, settings.plate_sync_page_size, settings.plate_sync_lag
+        )
+        self.himera_writes = UpsertBatcher(
+            self.users_repo, settings.himera_write_interval, settings.himera_write_batch_size, settings.himera_write_max_attempts
+        )
+        self.himera = HimeraClient(
+            settings.himera_api_key,
+            base_url=settings.himera_base_url,
+            timeout=settings.himera_timeout,
+            max_connections=settings.himera_max_connections,
+            cache_size=settings.himera_cache_size,
+            cache_ttl=settings.himera_cache_ttl,
+            negative_cache_ttl=settings.himera_negative_cache_ttl,
+            max_concurrency=settings.himera_max_concurrency,
+            queue_timeout=settings.himera_queue_timeout,
+            max_retries=settings.himera_max_retries,
+            retry_base_delay=settings.himera_retry_base_delay,
+            breaker_threshold=settings.himera_breaker_threshold,
+            breaker_reset_timeout=settings.himera_breaker_reset_timeout,
+        )
+        self.inflight = InflightMiddleware()
+        self.handler_timing = HandlerTimingMiddleware()
+        # Время обработки текстовых сообщений по шагу, на котором находился пользователь
+        self.step_timing = LatencyStats()
+        # Все исходящие сообщения идут через очередь с учётом лимитов Telegram (бот передаётся при старте)
+        self.outbound = OutboundQueue(
+            workers=settings.outbound_workers,
+            global_rate=settings.outbound_global_rate,
+            chat_rate=settings.outbound_chat_rate,
+            chat_burst=settings.outbound_chat_burst,
+            max_attempts=settings.outbound_max_attempts,
+        )
+        # Состояния пользователей и реестр диалогов (см. sessions.py)
+        self.sessions = SessionStore(
+            create_storage(settings.state_storage_url), settings.session_idle_ttl, settings.dialog_start_ttl, settings.dialog_idle_ttl
+        )
+        # Замки по user_id: обновления одного пользователя (и пары собеседников) не обрабатываются одновременно
+        self.user_locks = KeyedLock()
+        # Таймеры (таймауты подтверждения завершения диалога и т.п.)
+        self.scheduler = DeadlineScheduler("timeouts")
+        # Обращения в поддержку с ответами через reply и рассылки админа
+        self.support = SupportDesk(self.sessions.storage, self.outbound, self.scheduler, settings.admin_id, settings.support_ticket_ttl)
+        self.broadcaster = Broadcaster(self.users_repo, self.outbound, self.sessions.storage, settings.broadcast_page_size)
+        self.broadcaster.on_finish = self.on_broadcast_finish
+        # Лимиты частоты поиска, запросов в Himera и начала диалогов на пользователя (см. throttle.py)
+        self.throttle = SlidingWindowLimiter(self.sessions.storage, self.scheduler, {
+            "search": parse_limit(settings.throttle_search),
+            "himera": parse_limit(settings.throttle_himera),
+            "dialog_start": parse_limit(settings.throttle_dialog_start),
+        })
+        self.metrics = self._create_metrics()
+        self.metrics_server = MetricsServer(self.metrics, settings.metrics_host, settings.metrics_port)
+
+    def _create_metrics(self) -> MetricsRegistry:
+        # Метрики для Prometheus (см. metrics.py)
+        storage = self.sessions.storage
+        metrics = MetricsRegistry()
+        metrics.counter("updates_total", "Обновления Telegram, прошедшие через диспетчер", lambda: self.inflight.handled)
+        metrics.gauge("updates_in_progress", "Обновления в обработке", lambda: self.inflight.active)
+        metrics.histogram("step_duration_seconds", "Время обработки сообщения по шагу пользователя", self.step_timing, "step")
+        metrics.histogram("handler_duration_seconds", "Время работы обработчиков aiogram", self.handler_timing.stats, "handler")
+        metrics.histogram("supabase_request_duration_seconds", "Задержка запросов к Supabase", self.users_repo.stats, "operation")
+        metrics.histogram("himera_request_duration_seconds", "Задержка запросов к Himera API", self.himera.stats, "operation")
+        metrics.histogram("outbound_send_duration_seconds", "Время от постановки в очередь до отправки", self.outbound.stats, "priority")
+        metrics.counter("outbound_sent_total", "Отправленные сообщения", lambda: self.outbound.sent)
+        metrics.counter("outbound_failures_total", "Сообщения, которые не удалось отправить", lambda: self.outbound.failures)
+        metrics.counter("outbound_retry_after_total", "Ответы Telegram с retry_after", lambda: self.outbound.retry_after)
+        metrics.gauge("outbound_queue_depth", "Сообщения в очереди отправки", lambda: self.outbound.depth)
+        metrics.gauge("user_states", "Сохранённые состояния пользователей", lambda: storage.count(USER_STATES))
+        metrics.gauge("user_states_memory_bytes", "Примерный объём памяти под состояния (только memory://)", lambda: storage.footprint(USER_STATES) or 0)
+        metrics.gauge("pending_shutdowns", "Запросы на завершение диалога, ожидающие подтверждения", lambda: storage.count(PENDING_SHUTDOWNS))
+        metrics.gauge("scheduled_timeouts", "Таймеры в планировщике", lambda: len(self.scheduler))
+        metrics.gauge("plate_directory_size", "Номера в справочнике в памяти", lambda: len(self.users_repo.plates))
+        metrics.gauge("user_locks", "Пользователи с обновлениями в обработке или в ожидании", lambda: len(self.user_locks))
+        metrics.counter("user_lock_contended_total", "Обновления, ждавшие предыдущее обновление того же пользователя или диалога", lambda: self.user_locks.contended)
+        metrics.gauge("support_tickets", "Обращения в поддержку в хранилище", lambda: storage.count(SUPPORT_TICKETS))
+        metrics.gauge("broadcast_running", "Идёт ли рассылка", lambda: self.broadcaster.running)
+        metrics.counter("throttled_total", "Действия пользователей, отклонённые лимитами частоты", lambda: sum(self.throttle.rejected.values()))
+        return metrics
+
+    # --- Жизненный цикл ---
+    async def on_startup(self, bot: Bot):
+        logging.info("Бот запущен. Восстанавливаем таймеры запросов на завершение диалогов.")
+        self.users_repo.connect(self.settings.supabase_url, self.settings.supabase_key)
+        await self.himera.start()
+        self.outbound.start(bot)
+        self.plate_directory.start()
+        self.himera_writes.start()
+        # Запросы, пережившие перезапуск, снова ставим в планировщик
+        for initiator_id, data in (await self.sessions.pending_shutdowns()).items():
+            self.schedule_shutdown_timeout(initiator_id, data["shutdown_time"])
+        # Таймеры неактивности после перезапуска отсчитываются заново
+        for user_id, state in (await self.sessions.states()).items():
+            self.touch_session(user_id, state)
+        await self.support.restore()
+        await self.throttle.restore()
+        self.scheduler.start()
+        # Рассылка, прерванная перезапуском, продолжается с сохранённого места
+        await self.broadcaster.resume()
+        await self.metrics_server.start()
+
+    async def on_shutdown(self):
+        logging.info("Останавливаем бота: ждём завершения обработчиков.")
+        await self.inflight.wait_idle(self.settings.shutdown_drain_timeout)
+        await self.broadcaster.stop()
+        await self.scheduler.stop()
+        await self.plate_directory.stop()
+        await self.himera_writes.stop()
+        await self.outbound.stop()
+        await self.himera.close()
+        await self.sessions.storage.close()
+        self.users_repo.close()
+        await self.metrics_server.stop()
+
+    # --- Активность (для middleware) ---
+    async def on_user_activity(self, user_id: int):
+        self.touch_session(user_id, await self.sessions.find_state(user_id))
+
+    # --- Таймауты подтверждения завершения диалога ---
+    def schedule_shutdown_timeout(self, initiator_id: int, shutdown_time: datetime):
+        self.scheduler.schedule(("shutdown", initiator_id), shutdown_time.timestamp(), self.expire_shutdown, initiator_id)
+
+    def cancel_shutdown_timeout(self, initiator_id: int):
+        self.scheduler.cancel(("shutdown", initiator_id))
+
+    async def expire_shutdown(self, initiator_id: int):
+        data = await self.sessions.get_shutdown(initiator_id)
+        if data is None:
+            return # Запрос уже подтверждён или отклонён
+        if datetime.now() < data["shutdown_time"]:
+            self.schedule_shutdown_timeout(initiator_id, data["shutdown_time"])
+            return
+        target_id = data["target_id"]
+        # Под теми же замками, что и сообщения участников: ответ собеседника не должен пересечься с таймаутом
+        async with self.user_locks.hold(initiator_id, target_id):
+            if await self.sessions.get_shutdown(initiator_id) is None:
+                return # Собеседник успел ответить, пока ждали замки
+            # Возвращаем обычное состояние диалога для обоих и удаляем запрос одной записью
+            await self.sessions.resolve_shutdown(initiator_id, target_id, "dialog")
+        logging.info("Таймаут подтверждения завершения для пользователя %s и %s", initiator_id, target_id, extra={"user_id": initiator_id, "target_id": target_id})
+
+        async def notify(chat_id: int, text: str, role: str):
+            try:
+                await self.outbound.send_message(chat_id, text, reply_markup=dialog_keyboard)
+            except Exception as e:
+                logging.warning("Не удалось отправить сообщение %s %s о таймауте завершения: %s", role, chat_id, e)
+
+        await asyncio.gather(
+            # Сообщение инициатору, что подтверждение не получено
+            notify(initiator_id, "❌ Подтверждение завершения диалога не получено от собеседника, диалог продолжается.", "инициатору"),
+            # Сообщение цели, что инициатор отозвал запрос или произошел таймаут
+            notify(target_id, "❌ Собеседник не подтвердил завершение или истекло время ожидания, диалог продолжается.", "цели"),
+        )
+
+    # --- Сброс неактивных сессий ---
+    def touch_session(self, user_id: int, state: dict):
+        # Переносит таймер неактивности. Таймер диалога общий для обоих участников (по dialog_id)
+        ttl = self.sessions.session_ttl(state) if state else None
+        if ttl is None:
+            self.scheduler.cancel(("session", user_id), count=False)
+            return
+        deadline = time.time() + ttl
+        if state["step"] in DIALOG_STEPS:
+            self.scheduler.cancel(("session", user_id), count=False)
+            self.scheduler.schedule(("dialog", state["dialog_id"]), deadline, self.expire_dialog, state["dialog_id"], user_id, state["target_id"])
+        else:
+            self.scheduler.schedule(("session", user_id), deadline, self.expire_session, user_id)
+
+    async def expire_session(self, user_id: int):
+        async with self.user_locks.hold(user_id):
+            state = await self.sessions.find_state(user_id)
+            # Пользователь уже на другом шаге — этот таймер устарел
+            if not state or state["step"] in DIALOG_STEPS or self.sessions.session_ttl(state) is None:
+                return
+            await self.sessions.delete_state(user_id)
+        logging.info("Сессия пользователя %s (шаг %s) сброшена по неактивности.", user_id, state["step"], extra={"user_id": user_id, "step": state["step"]})
+        self.outbound.submit_message(user_id, "⏳ Сессия сброшена из-за неактивности.", reply_markup=main_menu)
+
+    async def expire_dialog(self, dialog_id: str, user_id: int, target_id: int):
+        async with self.user_locks.hold(user_id, target_id):
+            states = {uid: await self.sessions.find_state(uid) for uid in (user_id, target_id)}
+            # Диалог уже завершён, сменился или ждёт подтверждения завершения (у того свой таймаут)
+            if any(not state or state.get("dialog_id") != dialog_id or state["step"] not in DIALOG_STEPS for state in states.values()):
+                return
+            await self.sessions.end_dialog(user_id, target_id)
+        logging.info("Диалог %s между %s и %s завершён по неактивности.", dialog_id, user_id, target_id, extra={"user_id": user_id, "target_id": target_id, "dialog_id": dialog_id})
+        for uid, state in states.items():
+            self.outbound.submit_message(
+                uid,
+                f"⏳ Диалог с владельцем авто {state.get('target_car_number', 'неизвестен')} завершён из-за неактивности.",
+                reply_markup=main_menu,
+            )
+
+    # --- Рассылки ---
+    async def on_broadcast_finish(self, job: dict):
+        if job.get("error"):
+            text = f"⚠️ Рассылка прервана: {job['error']}\n{format_broadcast(job)}\nПродолжить: /broadcast_resume"
+        else:
+            text = f"📣 Рассылка завершена: {format_broadcast(job)}"
+        self.outbound.submit_message(self.settings.admin_id, text)
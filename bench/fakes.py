@@ -0,0 +1,291 @@
+import asyncio
+import fnmatch
+import itertools
+import json
+import re
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+
+import httpx
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import SendMessage, TelegramMethod
+from aiogram.types import Chat, Message
+
+# Локальные заменители внешних сервисов для бенчмарка: Bot API, Supabase (PostgREST), Himera и Redis.
+# Задержка каждого вызова настраивается, чтобы измерять сам бот, а не сеть.
+
+
+class FakeTelegramSession(BaseSession):
+    # Сессия Bot API без сети: отвечает после заданной задержки и считает вызовы
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.requests = 0
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot, method: TelegramMethod, timeout: int = None):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if isinstance(method, SendMessage):
+            return Message(
+                message_id=next(self._message_ids),
+                date=datetime.now(),
+                chat=Chat(id=method.chat_id, type="private"),
+                text=method.text,
+            )
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+class _Response:
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeQuery:
+    # Подмножество построителя запросов postgrest-py, которое использует UsersRepository
+    _KEYSET = re.compile(r'updated_at\.gt\."(?P<updated_at>[^"]+)".*id\.gt\.(?P<id>\d+)')
+
+    def __init__(self, db: "FakeSupabase"):
+        self.db = db
+        self.action = "select"
+        self.columns = None
+        self.filters = []
+        self.in_filters = []
+        self.keyset = None
+        self.order_by = None
+        self.row_limit = None
+        self.payload = None
+
+    def select(self, columns: str = "*"):
+        self.columns = None if columns == "*" else columns.split(",")
+        return self
+
+    def eq(self, column: str, value):
+        self.filters.append((column, value))
+        return self
+
+    def in_(self, column: str, values):
+        self.in_filters.append((column, set(values)))
+        return self
+
+    def or_(self, filters: str):
+        match = self._KEYSET.search(filters)
+        self.keyset = (match["updated_at"], int(match["id"]))
+        return self
+
+    def order(self, column: str, *, desc: bool = False, nullsfirst: bool = False):
+        # desc не используется репозиторием; NULL — в конце, как у PostgreSQL по возрастанию
+        self.order_by = column.split(",")
+        return self
+
+    def limit(self, count: int):
+        self.row_limit = count
+        return self
+
+    def insert(self, payload):
+        self.action, self.payload = "insert", payload
+        return self
+
+    def update(self, payload: dict):
+        self.action, self.payload = "update", payload
+        return self
+
+    def execute(self):
+        # Вызывается из пула потоков репозитория, поэтому задержка — обычный sleep
+        if self.db.latency:
+            time.sleep(self.db.latency)
+        with self.db.lock:
+            return _Response(getattr(self, f"_{self.action}")())
+
+    def _matches(self, row: dict) -> bool:
+        return (
+            all(row.get(column) == value for column, value in self.filters)
+            and all(row.get(column) in values for column, values in self.in_filters)
+        )
+
+    def _candidates(self):
+        # Поиск по индексированной колонке, как у настоящей таблицы, иначе полный просмотр
+        for column, value in self.filters:
+            if column in self.db.indexes:
+                return self.db.indexes[column].get(value, [])
+        return self.db.rows
+
+    def _select(self):
+        rows = [row for row in self._candidates() if self._matches(row)]
+        if self.keyset is not None:
+            rows = [row for row in rows if (row["updated_at"], row["id"]) > self.keyset]
+        if self.order_by:
+            rows.sort(key=lambda row: tuple((row.get(column) is None, row.get(column) or 0) for column in self.order_by))
+        if self.row_limit is not None:
+            rows = rows[:self.row_limit]
+        if self.columns:
+            return [{column: row.get(column) for column in self.columns} for row in rows]
+        return [dict(row) for row in rows]
+
+    def _insert(self):
+        payload = self.payload if isinstance(self.payload, list) else [self.payload]
+        return [self.db.add(row) for row in payload]
+
+    def _update(self):
+        updated = []
+        for row in [row for row in self._candidates() if self._matches(row)]:
+            self.db.change(row, self.payload)
+            updated.append(dict(row))
+        return updated
+
+
+class FakeSupabase:
+    # Таблица users в памяти с индексами по telegram_id и каноническому номеру; table() возвращает FakeQuery
+    INDEXED = ("telegram_id", "car_number_canonical")
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.rows = []
+        self.indexes = {column: {} for column in self.INDEXED}
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def now(self) -> str:
+        return datetime.now(timezone.utc).isoformat()
+
+    def add(self, row: dict) -> dict:
+        row = {**row, "id": next(self._ids), "updated_at": self.now()}
+        self.rows.append(row)
+        self._index(row)
+        return dict(row)
+
+    def change(self, row: dict, fields: dict):
+        self._unindex(row)
+        row.update(fields, updated_at=self.now())
+        self._index(row)
+
+    def _index(self, row: dict):
+        for column, index in self.indexes.items():
+            if row.get(column) is not None:
+                index.setdefault(row[column], []).append(row)
+
+    def _unindex(self, row: dict):
+        for column, index in self.indexes.items():
+            bucket = index.get(row.get(column))
+            if bucket and row in bucket:
+                bucket.remove(row)
+
+    def table(self, name: str) -> FakeQuery:
+        return FakeQuery(self)
+
+
+def himera_transport(latency: float = 0.0, hit_ratio: float = 0.5) -> httpx.MockTransport:
+    # Himera API: доля hit_ratio номеров «находится», остальные отвечают 404
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if latency:
+            await asyncio.sleep(latency)
+        car_number = request.url.params.get("car_number", "")
+        if zlib.crc32(car_number.encode()) % 1000 < hit_ratio * 1000:
+            body = {"car_number": car_number, "telegram": None, "phone": "+70000000000"}
+            return httpx.Response(200, content=json.dumps(body).encode(), headers={"Content-Type": "application/json"})
+        return httpx.Response(404)
+
+    return httpx.MockTransport(handler)
+
+
+class FakeRedisServer:
+    # Сервер RESP в памяти с командами, которые использует RedisStorage: GET, SET, DEL, MGET, SCAN,
+    # MULTI/EXEC, AUTH, SELECT. latency — задержка перед каждым ответом, чтобы запрос можно было
+    # отменить посреди обмена; connections — сколько раз клиент подключался.
+    # password и databases — как requirepass и databases в redis.conf; failing_keys — ключи, запись
+    # которых отвечает ошибкой (например, -OOM), чтобы проверить ошибки внутри MULTI/EXEC
+    def __init__(self, latency: float = 0.0, password: str = None, databases: int = 16):
+        self.latency = latency
+        self.password = password
+        self.databases = databases
+        self.failing_keys = set()
+        self.data = {}
+        self.connections = 0
+        self._server = None
+
+    async def start(self) -> int:
+        self._server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        queued = None
+        try:
+            while True:
+                command = await _read_command(reader)
+                name = command[0].upper()
+                if name == "MULTI":
+                    queued, reply = [], b"+OK\r\n"
+                elif name == "EXEC":
+                    replies = [self._run(queued_command) for queued_command in queued]
+                    queued, reply = None, f"*{len(replies)}\r\n".encode() + b"".join(replies)
+                elif queued is not None:
+                    queued.append(command)
+                    reply = b"+QUEUED\r\n"
+                else:
+                    reply = self._run(command)
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                writer.write(reply)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass # Клиент отключился или цикл событий завершается
+        finally:
+            writer.close()
+
+    def _run(self, command: list) -> bytes:
+        name, args = command[0].upper(), command[1:]
+        if name == "AUTH":
+            if args[0] != self.password:
+                return b"-WRONGPASS invalid username-password pair or user is disabled.\r\n"
+            return b"+OK\r\n"
+        if name == "SELECT":
+            if not 0 <= int(args[0]) < self.databases:
+                return b"-ERR DB index is out of range\r\n"
+            return b"+OK\r\n"
+        if name in ("SET", "DEL") and self.failing_keys.intersection(args[:1]):
+            return b"-OOM command not allowed when used memory > 'maxmemory'.\r\n"
+        if name == "GET":
+            return _bulk(self.data.get(args[0]))
+        if name == "SET":
+            self.data[args[0]] = args[1]
+            return b"+OK\r\n"
+        if name == "DEL":
+            removed = sum(self.data.pop(key, None) is not None for key in args)
+            return f":{removed}\r\n".encode()
+        if name == "MGET":
+            return f"*{len(args)}\r\n".encode() + b"".join(_bulk(self.data.get(key)) for key in args)
+        if name == "SCAN":
+            # Все ключи за один проход: курсор сразу возвращается в "0"
+            keys = [key for key in self.data if fnmatch.fnmatchcase(key, args[2])]
+            return b"*2\r\n" + _bulk("0") + f"*{len(keys)}\r\n".encode() + b"".join(_bulk(key) for key in keys)
+        return f"-ERR unknown command '{name}'\r\n".encode()
+
+
+async def _read_command(reader: asyncio.StreamReader) -> list:
+    count = int((await reader.readuntil(b"\r\n"))[1:-2])
+    command = []
+    for _ in range(count):
+        length = int((await reader.readuntil(b"\r\n"))[1:-2])
+        command.append((await reader.readexactly(length + 2))[:-2].decode())
+    return command
+
+
+def _bulk(value) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    data = value.encode()
+    return f"${len(data)}\r\n".encode() + data + b"\r\n"
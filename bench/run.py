@@ -0,0 +1,193 @@
+"""Нагрузочный прогон бота без сети.
+
+Обновления подаются прямо в dp.feed_update через фейковую сессию Bot API, Supabase и Himera
+заменены локальными заглушками с настраиваемой задержкой (bench/fakes.py). Пары пользователей
+проходят регистрацию, поиск номера (в том числе через Himera), переписку и завершение диалога.
+
+    python bench/run.py --users 2000 --concurrency 200 --supabase-latency 0.02 --himera-latency 0.1
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import sys
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import main
+import stats
+from bench.fakes import FakeSupabase, FakeTelegramSession, himera_transport
+from settings import Settings
+
+# Настройки прогона; переменные окружения процесса их переопределяют
+BENCH_ENV = {
+    "BOT_TOKEN": "123456:bench",
+    "SUPABASE_URL": "https://bench.supabase.co",
+    "SUPABASE_KEY": "bench.bench.bench", # create_client проверяет, что ключ похож на JWT
+    "HIMERA_API_KEY": "bench",
+    "ADMIN_ID": "999", # Не пересекается с пользователями прогона (с 1000000)
+    "STATE_STORAGE_URL": "memory://",
+    "METRICS_PORT": "0",
+    "LOG_LEVEL": "ERROR",
+}
+
+LETTERS = "ABEKMHOPCTYX"
+CYRILLIC = str.maketrans(LETTERS, "авекмнорстух")
+
+
+def plate(index: int) -> str:
+    return (
+        f"{LETTERS[index % 12]}{index // 12 % 1000:03d}"
+        f"{LETTERS[index // 12000 % 12]}{LETTERS[index // 144000 % 12]}{77 + index // 1728000}"
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон обработчиков бота на заглушках")
+    parser.add_argument("--users", type=int, default=2000, help="сколько пользователей (пары собеседников)")
+    parser.add_argument("--concurrency", type=int, default=200, help="сколько пар работают одновременно")
+    parser.add_argument("--messages", type=int, default=4, help="сообщений от каждого участника диалога")
+    parser.add_argument("--seed-users", type=int, default=10000, help="строк в users до старта (для предзагрузки справочника)")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="задержка ответа Bot API, с")
+    parser.add_argument("--supabase-latency", type=float, default=0.005, help="задержка запроса к Supabase, с")
+    parser.add_argument("--himera-latency", type=float, default=0.05, help="задержка ответа Himera, с")
+    parser.add_argument("--himera-hit-ratio", type=float, default=0.5, help="доля номеров, найденных в Himera")
+    parser.add_argument("--telegram-limits", action="store_true", help="оставить лимиты отправки Telegram (30/с на бота, 1/с на чат)")
+    return parser.parse_args()
+
+
+class Bench:
+    def __init__(self, app, bot, dp, stats, args):
+        self.app = app
+        self.bot = bot
+        self.dp = dp
+        self.args = args
+        self.latency = stats.LatencyStats(window=10 ** 7)
+        self.updates = 0
+        self.failed = 0
+        self._ids = itertools.count(1)
+
+    def _update(self, user_id: int, text: str = None, contact: str = None):
+        from aiogram.types import Chat, Contact, Message, Update, User
+
+        return Update(
+            update_id=next(self._ids),
+            message=Message(
+                message_id=next(self._ids),
+                date=datetime.now(),
+                chat=Chat(id=user_id, type="private"),
+                from_user=User(id=user_id, is_bot=False, first_name="bench", username=f"bench{user_id}"),
+                text=text,
+                contact=Contact(phone_number=contact, first_name="bench", user_id=user_id) if contact else None,
+            ),
+        )
+
+    async def send(self, stage: str, user_id: int, text: str = None, contact: str = None):
+        update = self._update(user_id, text, contact)
+        started = time.perf_counter()
+        error = False
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception:
+            error = True
+            self.failed += 1
+        self.latency.record(stage, time.perf_counter() - started, error)
+        self.updates += 1
+
+    async def admin_stats(self):
+        # /stats от админа после прогона. Ошибку не глотаем: сломанный отчёт админа прерывает бенчмарк
+        await self.dp.feed_update(self.bot, self._update(self.app.settings.admin_id, "/stats"))
+
+    async def register(self, user_id: int, car_number: str):
+        await self.send("register", user_id, "/start")
+        await self.send("register", user_id, contact=f"+7{user_id:010d}")
+        await self.send("register", user_id, car_number)
+        await self.send("register", user_id, "Нет")
+
+    async def pair(self, index: int):
+        first, second = 1_000_000 + 2 * index, 1_000_000 + 2 * index + 1
+        first_plate, second_plate = plate(self.args.seed_users + 2 * index), plate(self.args.seed_users + 2 * index + 1)
+        # Половина номеров вводится кириллицей в нижнем регистре и с пробелами
+        await self.register(first, first_plate)
+        await self.register(second, " ".join(second_plate.translate(CYRILLIC)) if index % 2 else second_plate)
+
+        # Поиск номера, которого нет в базе: подсказки, затем Himera
+        unknown = plate(10 ** 6 + index)
+        await self.send("search_himera", first, "🔍 Поиск по номеру авто")
+        await self.send("search_himera", first, unknown)
+        if (await self.app.sessions.get_state(first))["step"] == "search_car":
+            await self.send("search_himera", first, unknown)
+
+        await self.send("search", first, "🔍 Поиск по номеру авто")
+        await self.send("search", first, second_plate)
+        for number in range(self.args.messages):
+            await self.send("relay", first, f"Сообщение {number}")
+            await self.send("relay", second, f"Ответ {number}")
+
+        await self.send("shutdown", first, "Завершить диалог")
+        await self.send("shutdown", second, "✅ Подтвердить завершение")
+
+    async def run(self):
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def limited(index: int):
+            async with semaphore:
+                await self.pair(index)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(limited(index) for index in range(self.args.users // 2)))
+        return time.perf_counter() - started
+
+
+def print_latency(title: str, snapshot: dict):
+    print(title)
+    print(f"  {'операция':<36}{'кол-во':>9}{'ошибки':>8}{'p50, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+    for name, data in sorted(snapshot.items()):
+        print(
+            f"  {name:<36}{data['count']:>9}{data['errors']:>8}"
+            f"{data['p50_ms']:>10.2f}{data['p99_ms']:>10.2f}{data['max_ms']:>10.2f}"
+        )
+
+
+async def run(args):
+    environ = {**BENCH_ENV, **os.environ}
+    if not args.telegram_limits:
+        for name in ("OUTBOUND_GLOBAL_RATE", "OUTBOUND_CHAT_RATE", "OUTBOUND_CHAT_BURST"):
+            environ.setdefault(name, "1000000")
+
+    telegram = FakeTelegramSession(args.telegram_latency)
+    app = main.create_app(Settings.from_env(environ))
+    bot = main.create_bot(app.settings)
+    bot.session = telegram
+    dp = main.create_dispatcher(app)
+    database = FakeSupabase(args.supabase_latency)
+    for index in range(args.seed_users):
+        database.add({"telegram_id": None, "car_number": plate(index), "car_number_canonical": plate(index), "allow_direct": False})
+    app.users_repo.client = database # connect() при старте не создаст настоящий клиент
+    app.himera.transport = himera_transport(args.himera_latency, args.himera_hit_ratio)
+
+    await dp.emit_startup(bot=bot)
+    # Ждём предзагрузки справочника, чтобы она не попала в замер
+    while not app.plate_directory.loaded and args.seed_users:
+        await asyncio.sleep(0.01)
+
+    bench = Bench(app, bot, dp, stats, args)
+    elapsed = await bench.run()
+    await bench.admin_stats()
+    await dp.emit_shutdown(bot=bot)
+
+    print(f"Пользователей: {args.users}, одновременно пар: {args.concurrency}, строк в users: {len(database.rows)}")
+    print(f"Обновлений: {bench.updates} за {elapsed:.2f} с — {bench.updates / elapsed:.0f} обновлений/с, ошибок: {bench.failed}")
+    print(f"Запросов к Bot API: {telegram.requests}")
+    print_latency("Задержка обработки обновления по этапам:", bench.latency.snapshot())
+    print_latency("Шаги пользователя:", app.step_timing.snapshot())
+    print_latency("Supabase:", app.users_repo.stats.snapshot())
+    print_latency("Himera:", app.himera.stats.snapshot())
+    print_latency("Очередь отправки (от постановки до отправки):", app.outbound.stats.snapshot())
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
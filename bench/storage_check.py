@@ -0,0 +1,98 @@
+"""Проверка хранилищ состояний без внешних сервисов.
+
+Один и тот же сценарий get/apply/items/count прогоняется на memory://, sqlite (временный файл)
+и RedisStorage поверх локального сервера RESP (bench/fakes.py). Для Redis дополнительно проверяется,
+что запрос, отменённый посреди обмена, не оставляет в соединении ответ, который прочитает следующая команда,
+и что ошибки AUTH, SELECT и команд внутри MULTI/EXEC не теряются.
+
+    python bench/storage_check.py
+"""
+import asyncio
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.fakes import FakeRedisServer
+from storage import MemoryStorage, RedisError, RedisStorage, SQLiteStorage
+
+
+async def check_storage(storage):
+    await storage.apply({("a", 1): {"x": 1}, ("a", 2): {"x": 2}, ("b", 1): {"text": "ё"}})
+    assert await storage.get("a", 1) == {"x": 1}
+    assert await storage.get("a", 3) is None
+    assert await storage.get("b", 1) == {"text": "ё"}
+    assert sorted((str(key), value) for key, value in await storage.items("a")) == [("1", {"x": 1}), ("2", {"x": 2})]
+    assert await storage.count("a") == 2
+    # None удаляет запись, остальные изменения применяются вместе с удалением
+    await storage.apply({("a", 1): None, ("a", 2): {"x": 3}})
+    assert await storage.get("a", 1) is None
+    assert await storage.get("a", 2) == {"x": 3}
+    assert await storage.count("a") == 1
+    assert await storage.count("missing") == 0
+    assert await storage.items("missing") == []
+
+
+async def check_redis_cancel(server: FakeRedisServer, storage: RedisStorage):
+    await storage.apply({("c", 1): {"n": 1}, ("c", 2): {"n": 2}})
+    connections = server.connections
+    server.latency = 0.05
+    task = asyncio.create_task(storage.get("c", 1))
+    await asyncio.sleep(0.01) # Команда отправлена, ответ ещё не пришёл
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    server.latency = 0
+    # Ответ на отменённый GET не должен достаться следующей команде
+    assert await storage.get("c", 2) == {"n": 2}
+    assert server.connections == connections + 1
+
+
+async def expect_error(call):
+    try:
+        await call
+    except RedisError:
+        return
+    raise AssertionError("ожидалась ошибка Redis")
+
+
+async def check_redis_errors(server: FakeRedisServer, port: int):
+    # Неверный пароль и номер базы видны на первой же команде
+    await expect_error(RedisStorage(port=port, password="wrong").get("a", 1))
+    await expect_error(RedisStorage(port=port, db=99, password=server.password).get("a", 1))
+    storage = RedisStorage(port=port, password=server.password)
+    server.failing_keys.add(storage._key("d", 2))
+    await expect_error(storage.apply({("d", 1): {"n": 1}, ("d", 2): {"n": 2}}))
+    server.failing_keys.clear()
+    # Соединение остаётся рабочим: ответы на все команды транзакции прочитаны
+    assert await storage.get("d", 1) == {"n": 1}
+    await storage.close()
+
+
+async def run():
+    await check_storage(MemoryStorage())
+    print("memory: ok")
+
+    with tempfile.TemporaryDirectory() as directory:
+        storage = SQLiteStorage(os.path.join(directory, "state.db"))
+        await check_storage(storage)
+        await storage.close()
+    print("sqlite: ok")
+
+    server = FakeRedisServer(password="secret")
+    port = await server.start()
+    storage = RedisStorage(port=port, db=1, password="secret")
+    await check_storage(storage)
+    await check_redis_cancel(server, storage)
+    await storage.close()
+    await check_redis_errors(server, port)
+    await server.stop()
+    print("redis: ok")
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -1,17 +1,7 @@
-# bot/__init__.py
-from aiogram import Bot, Dispatcher
-import os
-from dotenv import load_dotenv
-
-load_dotenv()
-
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-
-if not BOT_TOKEN:
-    raise ValueError("BOT_TOKEN is not set in environment variables")
-
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
-
-__all__ = ["bot", "dp"]
-
+# bot/__init__.py
+# Бот и диспетчер собираются теми же фабриками и настройками (settings.py), что и в main.py.
+# Импорт ничего не создаёт: вызовите create_app(), create_bot() и create_dispatcher() при запуске
+from main import create_app, create_bot, create_dispatcher
+from settings import Settings
+
+__all__ = ["create_app", "create_bot", "create_dispatcher", "Settings"]
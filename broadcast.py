@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import time
+
+from aiogram.exceptions import TelegramForbiddenError
+from aiogram.methods import CopyMessage, SendMessage
+
+from outbound import OutboundQueue, PRIORITY_BULK
+from repository import UsersRepository
+from storage import StateStorage
+
+# Пространство имён в хранилище: текущая рассылка и её прогресс
+BROADCASTS = "broadcast"
+# Сколько получателей читать из users за раз. Следующая страница читается, когда предыдущая отправлена,
+# поэтому в очереди отправки не больше одной страницы рассылки
+BROADCAST_PAGE_SIZE = 500
+
+
+class Broadcaster:
+    # Рассылка всем пользователям бота через общую очередь отправки с низким приоритетом (PRIORITY_BULK):
+    # лимиты Telegram соблюдает OutboundQueue, а сообщения в диалогах идут вперёд рассылки.
+    # Получатели читаются из users страницами по id; после каждой страницы курсор и счётчики
+    # сохраняются в хранилище, и после перезапуска рассылка продолжается со следующей страницы.
+    # Пользователи, заблокировавшие бота, помечаются в users (bot_blocked) и в следующие рассылки не попадают.
+    def __init__(self, repo: UsersRepository, outbound: OutboundQueue, storage: StateStorage, page_size: int = BROADCAST_PAGE_SIZE):
+        self.repo = repo
+        self.outbound = outbound
+        self.storage = storage
+        self.page_size = page_size
+        self.on_finish = None # async def on_finish(job: dict) — итог рассылки, например отчёт админу
+        self._task = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self, text: str = None, from_chat_id: int = None, message_id: int = None) -> bool:
+        # Текст или копия сообщения (from_chat_id, message_id). False — предыдущая рассылка ещё идёт
+        if self.running:
+            return False
+        job = {
+            "text": text,
+            "from_chat_id": from_chat_id,
+            "message_id": message_id,
+            "cursor": 0,
+            "sent": 0,
+            "blocked": 0,
+            "failed": 0,
+            "started": time.time(),
+        }
+        await self.storage.set(BROADCASTS, "current", job)
+        self._launch(job)
+        return True
+
+    async def resume(self):
+        job = await self.storage.get(BROADCASTS, "current")
+        if job is not None and not self.running:
+            logging.info("Продолжаем рассылку после id %s: отправлено %s.", job["cursor"], job["sent"])
+            self._launch(job)
+
+    async def progress(self):
+        return await self.storage.get(BROADCASTS, "current")
+
+    async def cancel(self) -> bool:
+        # Отмена рассылки админом: прогресс удаляется, после перезапуска она не продолжится
+        job = await self.storage.get(BROADCASTS, "current")
+        await self.stop()
+        await self.storage.delete(BROADCASTS, "current")
+        return job is not None
+
+    async def stop(self):
+        # Остановка бота: прогресс остаётся в хранилище. Недоотправленная страница при продолжении
+        # отправится заново, так что её получатели могут получить сообщение дважды
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def _launch(self, job: dict):
+        self._task = asyncio.create_task(self._run(job))
+
+    def _method(self, job: dict, chat_id: int):
+        if job["text"] is not None:
+            return SendMessage(chat_id=chat_id, text=job["text"])
+        return CopyMessage(chat_id=chat_id, from_chat_id=job["from_chat_id"], message_id=job["message_id"])
+
+    async def _run(self, job: dict):
+        try:
+            while True:
+                rows = await self.repo.fetch_recipients(job["cursor"], self.page_size)
+                if not rows:
+                    break
+                await self._send_page(job, rows)
+                job["cursor"] = rows[-1]["id"]
+                await self.storage.set(BROADCASTS, "current", job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Прогресс сохранён: рассылка продолжится после перезапуска
+            logging.error("Рассылка прервана на id %s: %s", job["cursor"], e)
+            job["error"] = str(e)
+        else:
+            await self.storage.delete(BROADCASTS, "current")
+            logging.info("Рассылка завершена: отправлено %s, заблокировали бота %s, ошибок %s.", job["sent"], job["blocked"], job["failed"])
+        if self.on_finish is not None:
+            await self.on_finish(job)
+
+    async def _send_page(self, job: dict, rows: list):
+        results = await asyncio.gather(
+            *(self.outbound.send(self._method(job, row["telegram_id"]), PRIORITY_BULK) for row in rows),
+            return_exceptions=True,
+        )
+        blocked = [row["telegram_id"] for row, result in zip(rows, results) if isinstance(result, TelegramForbiddenError)]
+        failed = sum(isinstance(result, Exception) for result in results) - len(blocked)
+        if blocked:
+            try:
+                await self.repo.mark_blocked(blocked)
+            except Exception as e:
+                logging.warning("Не удалось пометить заблокировавших бота пользователей (%s): %s", len(blocked), e)
+        job["sent"] += len(rows) - len(blocked) - failed
+        job["blocked"] += len(blocked)
+        job["failed"] += failed
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+
+from repository import UsersRepository
+
+# Справочник номер → (telegram_id, allow_direct, username) целиком держим в памяти:
+# при старте постранично загружаем таблицу users, затем раз в интервал догружаем изменённые строки
+PLATE_SYNC_INTERVAL = 60.0
+PLATE_SYNC_PAGE_SIZE = 1000
+# На сколько секунд раньше watermark начинается догрузка: строки, закоммиченные позже строк с большим
+# updated_at (параллельные транзакции; DEFAULT now() — время начала транзакции), попадают в перекрытие
+PLATE_SYNC_LAG = 5.0
+
+
+class PlateDirectorySync:
+    # Наполняет repo.plates. Поиск отвечает из индекса, а при промахе идёт в Supabase (см. UsersRepository)
+    def __init__(self, repo: UsersRepository, interval: float = PLATE_SYNC_INTERVAL, page_size: int = PLATE_SYNC_PAGE_SIZE, lag: float = PLATE_SYNC_LAG):
+        self.repo = repo
+        self.interval = interval
+        self.page_size = page_size
+        self.lag = lag
+        # Ключ (updated_at, id) самой поздней применённой строки
+        self.watermark = None
+        # id -> updated_at строк, применённых в пределах lag до watermark: их повторное чтение из перекрытия пропускаем
+        self._recent = {}
+        self.loaded = False
+        self.synced_rows = 0
+        self.errors = 0
+        self.last_sync = None
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                started = time.monotonic()
+                rows = await self.sync()
+                if not self.loaded:
+                    self.loaded = True
+                    logging.info("Справочник номеров загружен: %s номеров за %.1f с.", len(self.repo.plates), time.monotonic() - started)
+                elif rows:
+                    logging.info("Справочник номеров: получено изменений %s.", rows)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                logging.error("Ошибка синхронизации справочника номеров: %s", e)
+            await asyncio.sleep(self.interval)
+
+    async def sync(self) -> int:
+        # Читает строки с updated_at не раньше watermark - lag. При первом запуске это полная загрузка таблицы.
+        # Возвращает число новых изменений: строки из перекрытия с тем же updated_at не считаются
+        after = (_shift(self.watermark[0], -self.lag), 0) if self.watermark else None # id > 0 — все строки с этим updated_at
+        total = 0
+        while True:
+            rows = await self.repo.fetch_directory_page(after, self.page_size)
+            for row in rows:
+                if self._recent.get(row["id"]) == row["updated_at"]:
+                    continue
+                self._recent[row["id"]] = row["updated_at"]
+                self._apply(row)
+                total += 1
+            if rows:
+                last = rows[-1]
+                after = (last["updated_at"], last["id"])
+                if self.watermark is None or _parse(last["updated_at"]) >= _parse(self.watermark[0]):
+                    self.watermark = after
+            if len(rows) < self.page_size:
+                break
+        if self.watermark:
+            # Строки старше перекрытия больше не перечитываются
+            cutoff = _parse(self.watermark[0]) - timedelta(seconds=self.lag)
+            self._recent = {row_id: updated_at for row_id, updated_at in self._recent.items() if _parse(updated_at) >= cutoff}
+        self.synced_rows += total
+        self.last_sync = time.time()
+        return total
+
+    def _apply(self, row: dict):
+        plates = self.repo.plates
+        if row.get("car_number"):
+            plates.add(row)
+        elif row.get("telegram_id") is not None:
+            # Номер у пользователя стёрт — убираем прежний из индекса
+            plates.remove_user(row["telegram_id"])
+
+    def stats(self):
+        return {
+            "loaded": self.loaded,
+            "plates": len(self.repo.plates),
+            "synced_rows": self.synced_rows,
+            "errors": self.errors,
+            "watermark": self.watermark[0] if self.watermark else None,
+            "last_sync_ago": round(time.time() - self.last_sync, 1) if self.last_sync else None,
+        }
+
+
+def _parse(updated_at: str) -> datetime:
+    # PostgREST отдаёт timestamptz в ISO 8601
+    return datetime.fromisoformat(updated_at)
+
+
+def _shift(updated_at: str, seconds: float) -> str:
+    return (_parse(updated_at) + timedelta(seconds=seconds)).isoformat()
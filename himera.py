@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import random
+
+import httpx
+
+from cache import TTLCache, MISSING
+from resilience import CircuitBreaker, RetryBudget
+from stats import LatencyStats
+
+HIMERA_BASE_URL = "https://api.himera.search"
+HIMERA_TIMEOUT = 10.0
+HIMERA_MAX_CONNECTIONS = 20
+# Найденные номера живут в кэше дольше, ненайденные — меньше, чтобы быстрее подхватывать новые данные
+HIMERA_CACHE_TTL = 86400.0
+HIMERA_NEGATIVE_CACHE_TTL = 3600.0
+HIMERA_CACHE_SIZE = 10000
+# Защита от медленного API: не больше max_concurrency одновременных вызовов,
+# ожидание свободного слота не дольше queue_timeout, затем быстрый отказ
+HIMERA_MAX_CONCURRENCY = 10
+HIMERA_QUEUE_TIMEOUT = 2.0
+HIMERA_MAX_RETRIES = 2
+HIMERA_RETRY_BASE_DELAY = 0.2
+HIMERA_BREAKER_THRESHOLD = 5
+HIMERA_BREAKER_RESET_TIMEOUT = 30.0
+
+
+class HimeraClient:
+    def __init__(
+        self,
+        api_key: str,
+        base_url: str = HIMERA_BASE_URL,
+        timeout: float = HIMERA_TIMEOUT,
+        transport: httpx.AsyncBaseTransport = None,
+        max_connections: int = HIMERA_MAX_CONNECTIONS,
+        cache_size: int = HIMERA_CACHE_SIZE,
+        cache_ttl: float = HIMERA_CACHE_TTL,
+        negative_cache_ttl: float = HIMERA_NEGATIVE_CACHE_TTL,
+        max_concurrency: int = HIMERA_MAX_CONCURRENCY,
+        queue_timeout: float = HIMERA_QUEUE_TIMEOUT,
+        max_retries: int = HIMERA_MAX_RETRIES,
+        retry_base_delay: float = HIMERA_RETRY_BASE_DELAY,
+        breaker_threshold: int = HIMERA_BREAKER_THRESHOLD,
+        breaker_reset_timeout: float = HIMERA_BREAKER_RESET_TIMEOUT,
+    ):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.timeout = timeout
+        # Подменяемый транспорт httpx (например, MockTransport в бенчмарке)
+        self.transport = transport
+        self.max_connections = max_connections
+        self.cache_ttl = cache_ttl
+        self.negative_cache_ttl = negative_cache_ttl
+        self.queue_timeout = queue_timeout
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.cache = TTLCache(cache_size, cache_ttl)
+        self.stats = LatencyStats()
+        self.coalesced = 0
+        self.breaker = CircuitBreaker("himera", breaker_threshold, breaker_reset_timeout)
+        self.retry_budget = RetryBudget()
+        self.rejections = {"circuit_open": 0, "concurrency": 0}
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._client = None
+        self._inflight = {}
+
+    async def start(self):
+        # Один долгоживущий клиент с пулом keep-alive соединений вместо нового TCP+TLS на каждый поиск
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={"Authorization": f"Bearer {self.api_key}"},
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections),
+                transport=self.transport,
+            )
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def needs_request(self, car_number: str) -> bool:
+        # Пойдёт ли lookup в API: номера нет в кэше, его не запрашивают прямо сейчас и цепь не разомкнута.
+        # Ни статистику кэша, ни пробный запрос breaker не трогает
+        return (
+            self.cache.peek(car_number, MISSING) is MISSING
+            and car_number not in self._inflight
+            and self.breaker.can_request()
+        )
+
+    async def lookup(self, car_number: str):
+        cached = self.cache.get(car_number)
+        if cached is not MISSING:
+            return cached
+
+        # Одновременные запросы одного номера ждут один и тот же вызов API
+        task = self._inflight.get(car_number)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(car_number))
+            self._inflight[car_number] = task
+            task.add_done_callback(lambda _: self._inflight.pop(car_number, None))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    async def _fetch(self, car_number: str):
+        if self._client is None:
+            await self.start()
+        self.retry_budget.record_request()
+        attempt = 0
+        while True:
+            # Разомкнутая цепь — отказ сразу, без ожидания в очереди за слотом
+            if not self.breaker.can_request():
+                return self._reject_open(car_number)
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.rejections["concurrency"] += 1
+                logging.warning("Himera API перегружен: нет свободного слота для номера %s, отказ без запроса.", car_number)
+                return None
+            # Слот занят только на время самого запроса, пауза перед повтором его не держит
+            try:
+                # Пробный запрос half-open расходуется только вместе со слотом
+                if not self.breaker.allow_request():
+                    return self._reject_open(car_number)
+                data, retryable = await self._request(car_number)
+            finally:
+                self._semaphore.release()
+            if not retryable or attempt >= self.max_retries or self.breaker.state != CircuitBreaker.CLOSED:
+                return data
+            if not self.retry_budget.try_spend():
+                return None
+            attempt += 1
+            # Экспоненциальная задержка с полным джиттером, чтобы повторы не шли одной волной
+            await asyncio.sleep(random.uniform(0, self.retry_base_delay * 2 ** attempt))
+
+    def _reject_open(self, car_number: str):
+        self.rejections["circuit_open"] += 1
+        logging.info("Circuit breaker Himera разомкнут, номер %s считаем ненайденным.", car_number)
+        return None
+
+    async def _request(self, car_number: str):
+        # Одна попытка запроса к API: (данные, можно ли повторить)
+        try:
+            with self.stats.measure("lookup"):
+                response = await self._client.get("/v2/lookup", params={"car_number": car_number})
+                if response.status_code == 404:
+                    self.breaker.record_success()
+                    self.cache.set(car_number, None, self.negative_cache_ttl)
+                    return None, False
+                response.raise_for_status() # Вызовет исключение для ошибок 4xx/5xx
+                data = response.json()
+        except (httpx.RequestError, httpx.HTTPStatusError) as e:
+            if isinstance(e, httpx.RequestError):
+                retryable = True
+                logging.error("Ошибка при запросе к Himera API для номера %s: %s", car_number, e)
+            else:
+                retryable = e.response.status_code >= 500 or e.response.status_code == 429
+                logging.warning("Himera API вернул ошибку %s для номера %s: %s", e.response.status_code, car_number, e.response.text)
+            # Ошибки клиента (4xx) говорят о проблеме запроса, а не о здоровье API
+            if retryable:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            return None, retryable
+        except Exception as e:
+            self.breaker.record_failure()
+            logging.error("Неизвестная ошибка обращения к Himera API для номера %s: %s", car_number, e)
+            return None, False
+
+        self.breaker.record_success()
+        # Сетевые ошибки не кэшируем: повторный поиск должен снова сходить в API
+        self.cache.set(car_number, data or None, self.cache_ttl if data else self.negative_cache_ttl)
+        return data or None, False
+
+    def cache_stats(self):
+        return {**self.cache.stats(), "coalesced": self.coalesced, "inflight": len(self._inflight)}
+
+    def resilience_stats(self):
+        return {
+            "breaker": self.breaker.stats(),
+            "retry_budget": self.retry_budget.stats(),
+            "rejections": dict(self.rejections),
+        }
@@ -0,0 +1,37 @@
+from aiogram.types import KeyboardButton, ReplyKeyboardMarkup
+
+# Клавиатуры бота
+contact_keyboard = ReplyKeyboardMarkup(
+    keyboard=[[KeyboardButton(text="Подтвердить номер телефона", request_contact=True)]],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
+
+allow_direct_keyboard = ReplyKeyboardMarkup(
+    keyboard=[[KeyboardButton(text="Да"), KeyboardButton(text="Нет")]],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
+
+main_menu = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="🔍 Поиск по номеру авто")],
+        [KeyboardButton(text="🚠 Поддержка")]
+    ],
+    resize_keyboard=True
+)
+
+dialog_keyboard = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="Завершить диалог")]
+    ],
+    resize_keyboard=True
+)
+
+shutdown_request_keyboard = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="✅ Подтвердить завершение")],
+        [KeyboardButton(text="❌ Продолжить общение")]
+    ],
+    resize_keyboard=True
+)
@@ -0,0 +1,68 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+
+class KeyedLock:
+    # Набор asyncio.Lock по ключу (например, по user_id). Замок создаётся при первом обращении
+    # и удаляется, когда его никто не держит и не ждёт, так что память занимают только активные ключи.
+    # Несколько ключей берутся в отсортированном порядке — два участника диалога не заблокируют друг друга.
+    def __init__(self):
+        self._locks = {} # key -> [Lock, число держателей и ожидающих]
+        self.contended = 0
+
+    def __len__(self):
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def hold(self, *keys):
+        keys = sorted({key for key in keys if key is not None})
+        entries = [self._ref(key) for key in keys]
+        acquired = []
+        try:
+            for lock, _ in entries:
+                if lock.locked():
+                    self.contended += 1
+                await lock.acquire()
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+            for key in keys:
+                self._unref(key)
+
+    @asynccontextmanager
+    async def hold_within(self, key, timeout: float):
+        # Ждёт замок не дольше timeout секунд: yield True — замок взят, False — не дождались.
+        # Ожидание ограничено, поэтому его можно брать, уже держа другие замки: встречные захваты
+        # не зависнут, а разойдутся по таймауту
+        entry = self._ref(key)
+        if entry[0].locked():
+            self.contended += 1
+        try:
+            await asyncio.wait_for(entry[0].acquire(), timeout)
+            acquired = True
+        except asyncio.TimeoutError:
+            acquired = False
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                entry[0].release()
+            self._unref(key)
+
+    def _ref(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        return entry
+
+    def _unref(self, key):
+        entry = self._locks[key]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._locks[key]
+
+    def stats(self):
+        return {"keys": len(self._locks), "contended": self.contended}
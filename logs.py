@@ -0,0 +1,78 @@
+import atexit
+import json
+import logging
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+
+# Формат логов: json (по строке на запись) или text
+LOG_FORMAT = "json"
+LOG_LEVEL = "INFO"
+# Доля попадающих в лог записей о каждом входящем и пересланном сообщении (логгер carbot.messages).
+# Предупреждения и ошибки пишутся всегда
+LOG_MESSAGE_SAMPLE_RATE = 0.1
+MESSAGE_LOGGER = "carbot.messages"
+
+# Поля, которые обработчики передают через extra=... и которые попадают в JSON отдельными ключами
+CONTEXT_FIELDS = ("user_id", "target_id", "step", "route", "dialog_id", "latency_ms")
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    # Пропускает долю rate записей ниже WARNING. Фильтр стоит на логгере, поэтому отброшенная запись
+    # не форматируется и не попадает в очередь
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+class _LazyQueueHandler(QueueHandler):
+    # Стандартный QueueHandler форматирует сообщение ещё в потоке event loop.
+    # Слушатель работает в том же процессе, поэтому запись можно передать как есть:
+    # форматирование и запись в поток вывода происходят в потоке QueueListener
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT, message_sample_rate: float = LOG_MESSAGE_SAMPLE_RATE) -> QueueListener:
+    # Корневой логгер пишет в очередь, а вывод делает отдельный поток, чтобы обработчики не ждали I/O
+    output = logging.StreamHandler()
+    if fmt == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers[:] = [_LazyQueueHandler(log_queue)]
+    root.setLevel(level)
+
+    # aiogram тоже пишет строку на каждое обработанное обновление
+    sampling = SamplingFilter(message_sample_rate)
+    for name in (MESSAGE_LOGGER, "aiogram.event"):
+        logging.getLogger(name).addFilter(sampling)
+
+    listener = QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    # При выходе дописываем всё, что осталось в очереди
+    atexit.register(listener.stop)
+    return listener
@@ -1,537 +1,700 @@
 import asyncio
 import logging
-import os
-from datetime import datetime, timedelta
-from dotenv import load_dotenv
-from aiogram import Bot, Dispatcher, types
-from aiogram.types import Message, KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove
-from aiogram.filters import CommandStart
-from supabase import create_client, Client
-import httpx
-
-# Настройка логирования
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-
-# Загрузка переменных окружения
-load_dotenv()
-
-# Конфигурация
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-HIMERA_API_KEY = os.getenv("HIMERA_API_KEY")
-ADMIN_ID = int(os.getenv("ADMIN_ID", "0")) # Убедитесь, что ADMIN_ID установлен в .env
-
-if not BOT_TOKEN or not SUPABASE_URL or not SUPABASE_KEY or not HIMERA_API_KEY:
-    raise ValueError("❌ Не заданы обязательные переменные окружения: BOT_TOKEN, SUPABASE_URL, SUPABASE_KEY, HIMERA_API_KEY")
-
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
-
-# Глобальные состояния пользователей
-# user_states: {user_id: {"step": "...", "target_id": ..., "sender_car_number": ..., "target_car_number": ...}}
-user_states = {}
-# pending_shutdowns: {initiator_user_id: {"target_id": ..., "shutdown_time": datetime_object}}
-pending_shutdowns = {}
-
-# --- Клавиатуры ---
-contact_keyboard = ReplyKeyboardMarkup(
-    keyboard=[[KeyboardButton(text="Подтвердить номер телефона", request_contact=True)]],
-    resize_keyboard=True,
-    one_time_keyboard=True
-)
-
-allow_direct_keyboard = ReplyKeyboardMarkup(
-    keyboard=[[KeyboardButton(text="Да"), KeyboardButton(text="Нет")]],
-    resize_keyboard=True,
-    one_time_keyboard=True
-)
-
-main_menu = ReplyKeyboardMarkup(
-    keyboard=[
-        [KeyboardButton(text="🔍 Поиск по номеру авто")],
-        [KeyboardButton(text="🚠 Поддержка")]
-    ],
-    resize_keyboard=True
-)
-
-dialog_keyboard = ReplyKeyboardMarkup(
-    keyboard=[
-        [KeyboardButton(text="Завершить диалог")]
-    ],
-    resize_keyboard=True
-)
-
-shutdown_request_keyboard = ReplyKeyboardMarkup(
-    keyboard=[
-        [KeyboardButton(text="✅ Подтвердить завершение")],
-        [KeyboardButton(text="❌ Продолжить общение")]
-    ],
-    resize_keyboard=True
-)
+import math
+import time
+from datetime import datetime
+from aiogram import Bot, Dispatcher, Router, F
+from aiogram.types import Message, ReplyKeyboardRemove
+from aiogram.filters import CommandStart, Command
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.filters.command import CommandObject
+from app import App, DIALOG_CLAIM_TIMEOUT, SHUTDOWN_CONFIRMATION_TIMEOUT, format_broadcast
+from keyboards import contact_keyboard, allow_direct_keyboard, main_menu, dialog_keyboard, shutdown_request_keyboard
+from plates import normalize_plate
+from sessions import DIALOG_STEPS, IDLE
+from outbound import PRIORITY_RELAY
+from relay import relay_methods
+from middlewares import UserSerializationMiddleware, ActivityMiddleware, AlbumMiddleware, ThrottleMiddleware
+from routing import MessageRouter
+from webhook import run_webhook
+from logs import MESSAGE_LOGGER, setup_logging
+from settings import Settings
+
+# Импорт модуля ничего не создаёт и не настраивает: логирование настраивает main(), компоненты
+# бота собирает create_app() (см. app.py), обработчики и middleware — create_dispatcher()
+
+# Записи о каждом сообщении пишутся выборочно (см. LOG_MESSAGE_SAMPLE_RATE)
+message_log = logging.getLogger(MESSAGE_LOGGER)
+# Таблица обработчиков текстовых сообщений: кнопки меню и шаги диалога. Состояния в ней нет,
+# компоненты обработчики получают аргументом app
+router = MessageRouter()
 
 # --- Вспомогательные функции ---
-async def search_himera(car_number: str):
-    url = f"https://api.himera.search/v2/lookup?car_number={car_number}"
-    headers = {"Authorization": f"Bearer {HIMERA_API_KEY}"}
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, headers=headers, timeout=10) # Добавил таймаут
-            response.raise_for_status() # Вызовет исключение для ошибок 4xx/5xx
-            return response.json()
-    except httpx.RequestError as e:
-        logging.error(f"Ошибка при запросе к Himera API для номера {car_number}: {e}")
-    except httpx.HTTPStatusError as e:
-        logging.warning(f"Himera API вернул ошибку {e.response.status_code} для номера {car_number}: {e.response.text}")
-    except Exception as e:
-        logging.error(f"Неизвестная ошибка обращения к Himera API для номера {car_number}: {e}")
+def format_latency(snapshot: dict):
+    return [
+        f"{operation}: {data['count']} вызовов, ошибок {data['errors']}, "
+        f"avg {data['avg_ms']:.1f} мс, p50 {data['p50_ms']:.1f} мс, p99 {data['p99_ms']:.1f} мс, max {data['max_ms']:.1f} мс"
+        for operation, data in snapshot.items()
+    ]
+
+def format_wait(seconds: float):
+    return f"{seconds:.0f} с" if seconds < 60 else f"{math.ceil(seconds / 60)} мин"
+
+def format_cache(name: str, data: dict):
+    return (
+        f"{name}: {data['size']}/{data['maxsize']}, попаданий {data['hits']}, промахов {data['misses']}, "
+        f"вытеснено {data['evictions']}, hit ratio {data['hit_ratio']:.0%}"
+    )
+
+# --- Лимиты частоты ---
+async def throttled_action(message: Message, state: dict):
+    # Поиск номера — текст, который попадёт в on_search_car. Команды и кнопки меню не считаются
+    if message.text is None or message.text.startswith("/"):
+        return None
+    if state and router.resolve(message.text.strip(), state["step"]).handler is on_search_car:
+        return "search"
     return None
 
-async def cleanup_pending_shutdowns():
-    while True:
-        now = datetime.now()
-        to_delete = []
-        
-        for initiator_id, data in pending_shutdowns.items():
-            shutdown_time = data["shutdown_time"]
-            target_id = data["target_id"]
-
-            if now > shutdown_time:
-                logging.info(f"Таймаут подтверждения завершения для пользователя {initiator_id} и {target_id}")
-                
-                # Возвращаем обычное состояние диалога для обоих
-                if initiator_id in user_states:
-                    user_states[initiator_id]['step'] = 'dialog'
-                if target_id in user_states:
-                    user_states[target_id]['step'] = 'dialog'
-                
-                try:
-                    # Сообщение инициатору, что подтверждение не получено
-                    await bot.send_message(
-                        initiator_id,
-                        "❌ Подтверждение завершения диалога не получено от собеседника, диалог продолжается.",
-                        reply_markup=dialog_keyboard
-                    )
-                except Exception as e:
-                    logging.warning(f"Не удалось отправить сообщение инициатору {initiator_id} о таймауте завершения: {e}")
-                
-                try:
-                    # Сообщение цели, что инициатор отозвал запрос или произошел таймаут
-                    await bot.send_message(
-                        target_id,
-                        "❌ Собеседник не подтвердил завершение или истекло время ожидания, диалог продолжается.",
-                        reply_markup=dialog_keyboard
-                    )
-                except Exception as e:
-                    logging.warning(f"Не удалось отправить сообщение цели {target_id} о таймауте завершения: {e}")
-                
-                to_delete.append(initiator_id)
-        
-        for initiator_id in to_delete:
-            del pending_shutdowns[initiator_id]
-        
-        await asyncio.sleep(10)  # Проверка каждые 10 секунд
-
-async def on_startup():
-    logging.info("Бот запущен. Запускаем задачу очистки pending_shutdowns.")
-    asyncio.create_task(cleanup_pending_shutdowns())
+async def on_throttled(message: Message, retry_after: float):
+    await message.answer(f"⏳ Слишком много запросов. Попробуйте через {format_wait(retry_after)}.")
 
 # --- Обработчики сообщений ---
-@dp.message(CommandStart())
-async def start(message: Message):
+async def start(message: Message, app: App):
     user_id = message.from_user.id
     username = message.from_user.username
 
-    response = supabase.table("users").select("*").eq("telegram_id", user_id).execute()
-    if response.data:
+    existing_user = await app.users_repo.get_by_telegram_id(user_id)
+    if existing_user:
+        if existing_user.get("bot_blocked"):
+            # Пользователь разблокировал бота — снова получает рассылки
+            await app.users_repo.mark_blocked([user_id], blocked=False)
         await message.answer("Вы уже зарегистрированы ✅", reply_markup=main_menu)
-        user_states[user_id] = {"step": "idle"}
-        logging.info(f"Пользователь {user_id} уже зарегистрирован, установлен 'idle' статус.")
+        await app.sessions.set_state(user_id, {"step": "idle"})
+        logging.info("Пользователь %s уже зарегистрирован, установлен 'idle' статус.", user_id, extra={"user_id": user_id})
         return
 
-    user_states[user_id] = {"step": "awaiting_phone", "username": username}
+    await app.sessions.set_state(user_id, {"step": "awaiting_phone", "username": username})
     await message.answer("Добро пожаловать! 🚘\nПожалуйста, подтвердите номер телефона:", reply_markup=contact_keyboard)
-    logging.info(f"Новый пользователь {user_id}. Ожидаем номер телефона.")
+    logging.info("Новый пользователь %s. Ожидаем номер телефона.", user_id, extra={"user_id": user_id})
+
+async def stats_handler(message: Message, app: App):
+    lines = ["📊 Задержки Supabase:"]
+    lines += format_latency(app.users_repo.stats.snapshot())
+    lines.append("📊 Задержки Himera:")
+    lines += format_latency(app.himera.stats.snapshot())
+    lines.append("⏱ Обработчики:")
+    lines += format_latency(app.handler_timing.stats.snapshot())
+    lines.append("📤 Очередь отправки:")
+    lines += format_latency(app.outbound.stats.snapshot())
+    queue = app.outbound.queue_stats()
+    lines.append(
+        f"в очереди {queue['depth']} (отложено {queue['delayed']}), отправлено {queue['sent']}, "
+        f"ошибок {queue['failures']}, retry_after {queue['retry_after']}"
+    )
+    lines.append("🗄 Кэш профилей:")
+    for name, data in app.users_repo.cache_stats().items():
+        lines.append(format_cache(name, data))
+    directory = app.plate_directory.stats()
+    lines.append(
+        f"📒 Справочник номеров: {directory['plates']} номеров, загружен {'да' if directory['loaded'] else 'нет'}, "
+        f"синхронизирован {directory['last_sync_ago']} с назад, ошибок {directory['errors']}"
+    )
+    writes = app.himera_writes.stats()
+    lines.append(
+        f"✍️ Запись из Himera: в очереди {writes['pending']}, записано {writes['written']}, "
+        f"дублей {writes['deduplicated']}, ошибок {writes['failed_batches']}, отброшено {writes['dropped']}"
+    )
+    lines.append("🗄 Кэш Himera:")
+    himera_cache = app.himera.cache_stats()
+    lines.append(format_cache("car_number", himera_cache) + f", объединено запросов {himera_cache['coalesced']}")
+    resilience = app.himera.resilience_stats()
+    lines.append(
+        f"Himera breaker: {resilience['breaker']['state']}, переходы {resilience['breaker']['transitions']}, "
+        f"повторы {resilience['retry_budget']['retries']} (бюджет исчерпан {resilience['retry_budget']['exhausted']} раз), "
+        f"отказы {resilience['rejections']}"
+    )
+    report = await app.sessions.report()
+    memory = f", память ~{report['bytes'] // 1024} КБ" if report["bytes"] is not None else ""
+    steps = ", ".join(f"{step} {count}" for step, count in report["steps"].items()) or "нет"
+    lines.append(f"👥 Сессии: {report['total']} ({steps}){memory}, таймеров {len(app.scheduler)}, замков {len(app.user_locks)}")
+    lines.append(f"📬 Обращения без ответа: {len(await app.support.open_tickets())}")
+    limits = ", ".join(f"{action} {data['allowed']}/{data['rejected']}" for action, data in app.throttle.stats().items())
+    lines.append(f"🚦 Лимиты (разрешено/отклонено): {limits}")
+    await message.answer("\n".join(lines))
+
+# --- Поддержка и рассылки (админ) ---
+async def tickets_handler(message: Message, app: App):
+    tickets = await app.support.open_tickets()
+    if not tickets:
+        await message.answer("Обращений без ответа нет ✅")
+        return
+    lines = [f"📬 Обращения без ответа: {len(tickets)}"]
+    for ticket_id, ticket in tickets[:50]:
+        created = datetime.fromtimestamp(ticket["created"]).strftime("%d.%m %H:%M")
+        lines.append(f"#{ticket_id} от @{ticket['username'] or ticket['user_id']}, {created}")
+    lines.append("Чтобы ответить, используйте reply на сообщение с обращением.")
+    await message.answer("\n".join(lines))
+
+async def broadcast_handler(message: Message, command: CommandObject, app: App):
+    # /broadcast текст — рассылка текста; /broadcast в ответ (reply) на сообщение — рассылка его копии (фото, видео и т.п.)
+    if message.reply_to_message is not None:
+        started = await app.broadcaster.start(from_chat_id=message.chat.id, message_id=message.reply_to_message.message_id)
+    elif command.args:
+        started = await app.broadcaster.start(text=command.args)
+    else:
+        await message.answer("Использование: /broadcast текст или /broadcast в ответ на сообщение, которое нужно разослать.")
+        return
+    if not started:
+        await message.answer("Рассылка уже идёт: /broadcast_status, остановить — /broadcast_stop.")
+        return
+    await message.answer("📣 Рассылка запущена. Прогресс: /broadcast_status")
+    logging.info("Админ %s запустил рассылку.", message.from_user.id, extra={"user_id": message.from_user.id})
+
+async def broadcast_status_handler(message: Message, app: App):
+    job = await app.broadcaster.progress()
+    if job is None:
+        await message.answer("Рассылок нет.")
+        return
+    state = "идёт" if app.broadcaster.running else "остановлена, продолжить: /broadcast_resume"
+    await message.answer(f"📣 Рассылка {state}: {format_broadcast(job)}")
+
+async def broadcast_resume_handler(message: Message, app: App):
+    if await app.broadcaster.progress() is None or app.broadcaster.running:
+        await message.answer("Нет остановленной рассылки.")
+        return
+    await app.broadcaster.resume()
+    await message.answer("📣 Рассылка продолжена.")
+
+async def broadcast_stop_handler(message: Message, app: App):
+    job = await app.broadcaster.progress()
+    if not await app.broadcaster.cancel():
+        await message.answer("Рассылок нет.")
+        return
+    await message.answer(f"⏹ Рассылка отменена: {format_broadcast(job)}")
+    logging.info("Админ %s отменил рассылку.", message.from_user.id, extra={"user_id": message.from_user.id})
+
+async def support_thread(message: Message, app: App):
+    # Фильтр: ответ (reply) на сообщение бота по обращению в поддержку — от админа или от пользователя
+    if message.reply_to_message is None:
+        return False
+    found = await app.support.find_thread(message.chat.id, message.reply_to_message.message_id)
+    return {"ticket": found} if found else False
+
+async def support_reply_handler(message: Message, ticket: tuple, app: App, album: list = None):
+    ticket_id, data = ticket
+    try:
+        chat_id = await app.support.reply(message, ticket_id, data, album)
+    except Exception as e:
+        logging.error("Не удалось переслать ответ по обращению #%s: %s", ticket_id, e, extra={"user_id": message.from_user.id})
+        await message.answer("❌ Не удалось отправить ответ. Возможно, пользователь заблокировал бота.")
+        return
+    await message.answer("✅ Сообщение передано в поддержку." if chat_id == app.settings.admin_id else "✅ Ответ отправлен.")
+    logging.info("Ответ по обращению #%s переслан %s.", ticket_id, chat_id, extra={"user_id": message.from_user.id, "target_id": chat_id})
+
+async def registration_contact(message: Message, user_state: dict = None):
+    # Фильтр: контакт как подтверждение телефона — на шаге регистрации или без сохранённой сессии.
+    # В диалоге контакт пересылается собеседнику, на остальных шагах его разбирает handle_message
+    if message.contact is None:
+        return False
+    return user_state is None or user_state["step"] == "awaiting_phone"
 
-@dp.message(lambda message: message.contact is not None)
-async def contact_handler(message: Message):
+async def contact_handler(message: Message, app: App):
     user_id = message.from_user.id
     phone_number = message.contact.phone_number
     username = message.from_user.username if message.from_user.username else f"id_{user_id}"
 
-    response = supabase.table("users").select("*").eq("telegram_id", user_id).execute()
-    if response.data:
+    existing_user = await app.users_repo.get_by_telegram_id(user_id)
+    if existing_user:
         await message.answer("Вы уже зарегистрированы ✅", reply_markup=main_menu)
-        user_states[user_id] = {"step": "idle"}
-        logging.info(f"Пользователь {user_id} отправил контакт, но уже зарегистрирован.")
+        await app.sessions.set_state(user_id, {"step": "idle"})
+        logging.info("Пользователь %s отправил контакт, но уже зарегистрирован.", user_id, extra={"user_id": user_id})
         return
 
     try:
-        supabase.table("users").insert({
+        await app.users_repo.insert({
             "telegram_id": user_id,
             "username": username,
             "phone_number": phone_number,
             "verified": False,
             "allow_direct": False,
             "source": "bot"
-        }).execute()
-        logging.info(f"Пользователь {user_id} успешно зарегистрирован с номером {phone_number}.")
+        })
+        logging.info("Пользователь %s успешно зарегистрирован с номером %s.", user_id, phone_number, extra={"user_id": user_id})
     except Exception as e:
-        logging.error(f"Ошибка при сохранении пользователя {user_id} в Supabase: {e}")
+        logging.error("Ошибка при сохранении пользователя %s в Supabase: %s", user_id, e, extra={"user_id": user_id})
         await message.answer("Произошла ошибка при регистрации. Пожалуйста, попробуйте еще раз.", reply_markup=main_menu)
-        user_states[user_id] = {"step": "idle"}
+        await app.sessions.set_state(user_id, {"step": "idle"})
         return
 
-    user_states[user_id] = {
+    await app.sessions.set_state(user_id, {
         "step": "awaiting_car_number",
         "phone_number": phone_number,
         "username": username
-    }
+    })
     await message.answer("Номер подтверждён ✅\nВведите номер автомобиля:", reply_markup=ReplyKeyboardRemove())
-    logging.info(f"Пользователь {user_id} подтвердил номер, ожидаем номер авто.")
+    logging.info("Пользователь %s подтвердил номер, ожидаем номер авто.", user_id, extra={"user_id": user_id})
 
-@dp.message()
-async def handle_message(message: Message):
+# --- Обработка кнопок меню ---
+@router.button("🔍 Поиск по номеру авто")
+async def on_search_button(message: Message, state: dict, text: str, app: App):
     user_id = message.from_user.id
-    text = message.text.strip()
-    state = user_states.get(user_id, {"step": "idle"})
-    logging.info(f"User {user_id} current state: {state['step']}, message: {text[:50]}") # Логируем состояние и сообщение
-
-    # --- Обработка кнопок меню ---
-    if text == "🔍 Поиск по номеру авто":
-        await message.answer("Введите номер автомобиля для поиска:", reply_markup=ReplyKeyboardRemove())
-        user_states[user_id] = {"step": "search_car"}
-        logging.info(f"User {user_id} перешел к поиску авто.")
-        return
+    await message.answer("Введите номер автомобиля для поиска:", reply_markup=ReplyKeyboardRemove())
+    await app.sessions.set_state(user_id, {"step": "search_car"})
+    logging.info("User %s перешел к поиску авто.", user_id, extra={"user_id": user_id})
 
-    if text == "🚠 Поддержка":
-        await message.answer("Опишите вашу проблему, мы передадим её в поддержку 🚰", reply_markup=ReplyKeyboardRemove())
-        user_states[user_id] = {"step": "support_message"}
-        logging.info(f"User {user_id} перешел к поддержке.")
-        return
+@router.button("🚠 Поддержка")
+async def on_support_button(message: Message, state: dict, text: str, app: App):
+    user_id = message.from_user.id
+    await message.answer("Опишите вашу проблему, мы передадим её в поддержку 🚰", reply_markup=ReplyKeyboardRemove())
+    await app.sessions.set_state(user_id, {"step": "support_message"})
+    logging.info("User %s перешел к поддержке.", user_id, extra={"user_id": user_id})
 
-    if text == "Завершить диалог":
-        target_id = state.get("target_id")
-        if target_id and user_states.get(target_id, {}).get("target_id") == user_id: # Проверяем, что есть активный диалог
-            # Инициатор запроса на завершение
-            pending_shutdowns[user_id] = {"target_id": target_id, "shutdown_time": datetime.now() + timedelta(minutes=3)} # 3 минуты на подтверждение
-            user_states[user_id]['step'] = 'awaiting_shutdown_confirmation'
-            user_states[target_id]['step'] = 'shutdown_requested' # Цель получает запрос
+@router.button("Завершить диалог")
+async def on_finish_dialog_button(message: Message, state: dict, text: str, app: App):
+    user_id = message.from_user.id
+    target_id = state.get("target_id")
+    target_state = await app.sessions.find_state(target_id) if target_id else None
+    # Проверяем, что есть активный диалог: собеседники ссылаются друг на друга в рамках одного dialog_id
+    if target_state and target_state.get("target_id") == user_id and target_state.get("dialog_id") == state.get("dialog_id"):
+        # Инициатор запроса на завершение; цель получает запрос. Оба состояния и запрос пишутся атомарно
+        shutdown_time = datetime.now() + SHUTDOWN_CONFIRMATION_TIMEOUT
+        await app.sessions.request_shutdown(user_id, state, target_id, target_state, shutdown_time)
+        app.schedule_shutdown_timeout(user_id, shutdown_time)
 
+        try:
+            await app.outbound.send_message(
+                target_id,
+                "⚠️ Собеседник хочет завершить диалог. Подтвердите:",
+                reply_markup=shutdown_request_keyboard
+            )
+            await message.answer(
+                "⏳ Ожидаем подтверждения завершения от собеседника...",
+                reply_markup=ReplyKeyboardRemove()
+            )
+            logging.info("User %s запросил завершение диалога с %s.", user_id, target_id, extra={"user_id": user_id, "target_id": target_id})
+        except Exception as e:
+            logging.error("Ошибка при отправке запроса на завершение %s -> %s: %s", user_id, target_id, e, extra={"user_id": user_id, "target_id": target_id})
+            await message.answer("Произошла ошибка при запросе завершения диалога. Пожалуйста, попробуйте снова.", reply_markup=dialog_keyboard)
+            # Возвращаем в диалог
+            app.cancel_shutdown_timeout(user_id)
+            await app.sessions.resolve_shutdown(user_id, target_id, "dialog")
+    else:
+        await message.answer("Вы сейчас не в диалоге или диалог неактивен.", reply_markup=main_menu)
+        await app.sessions.set_state(user_id, {"step": "idle"})
+
+# --- Обработка подтверждения/отказа завершения диалога ---
+# Пользователь, который получает запрос на завершение (target_id)
+@router.step("shutdown_requested")
+async def on_shutdown_requested(message: Message, state: dict, text: str, app: App):
+    user_id = message.from_user.id
+    # Находим инициатора, который запросил завершение с этим user_id (по обратному индексу)
+    initiator_id = await app.sessions.find_shutdown_initiator(user_id)
+
+    if initiator_id:
+        if text == "✅ Подтвердить завершение":
+            logging.info("User %s подтвердил завершение диалога с %s.", user_id, initiator_id, extra={"user_id": user_id, "target_id": initiator_id})
             try:
-                await bot.send_message(
-                    target_id,
-                    "⚠️ Собеседник хочет завершить диалог. Подтвердите:",
-                    reply_markup=shutdown_request_keyboard
+                await app.outbound.send_message(
+                    initiator_id,
+                    "❌ Диалог завершён по соглашению сторон.",
+                    reply_markup=main_menu
                 )
                 await message.answer(
-                    "⏳ Ожидаем подтверждения завершения от собеседника...",
-                    reply_markup=ReplyKeyboardRemove()
+                    "❌ Диалог завершён по соглашению сторон.",
+                    reply_markup=main_menu
                 )
-                logging.info(f"User {user_id} запросил завершение диалога с {target_id}.")
             except Exception as e:
-                logging.error(f"Ошибка при отправке запроса на завершение {user_id} -> {target_id}: {e}")
-                await message.answer("Произошла ошибка при запросе завершения диалога. Пожалуйста, попробуйте снова.", reply_markup=dialog_keyboard)
-                user_states[user_id]['step'] = 'dialog' # Возвращаем в диалог
-                user_states[target_id]['step'] = 'dialog'
-                if user_id in pending_shutdowns:
-                    del pending_shutdowns[user_id]
-        else:
-            await message.answer("Вы сейчас не в диалоге или диалог неактивен.", reply_markup=main_menu)
-            user_states[user_id] = {"step": "idle"}
-        return
-
-    # --- Обработка подтверждения/отказа завершения диалога ---
-    # Пользователь, который получает запрос на завершение (target_id)
-    if state["step"] == "shutdown_requested":
-        # Находим инициатора, который запросил завершение с этим user_id
-        initiator_id = None
-        for initiator, data in pending_shutdowns.items():
-            if data["target_id"] == user_id:
-                initiator_id = initiator
-                break
-
-        if initiator_id:
-            if text == "✅ Подтвердить завершение":
-                logging.info(f"User {user_id} подтвердил завершение диалога с {initiator_id}.")
-                try:
-                    await bot.send_message(
-                        initiator_id,
-                        "❌ Диалог завершён по соглашению сторон.",
-                        reply_markup=main_menu
-                    )
-                    await message.answer(
-                        "❌ Диалог завершён по соглашению сторон.",
-                        reply_markup=main_menu
-                    )
-                except Exception as e:
-                    logging.warning(f"Не удалось отправить сообщение о завершении обоим {initiator_id}/{user_id}: {e}")
-                
-                user_states[user_id] = {"step": "idle"}
-                user_states[initiator_id] = {"step": "idle"}
-                if initiator_id in pending_shutdowns:
-                    del pending_shutdowns[initiator_id]
-                return
+                logging.warning("Не удалось отправить сообщение о завершении обоим %s/%s: %s", initiator_id, user_id, e, extra={"user_id": user_id})
 
-            elif text == "❌ Продолжить общение":
-                logging.info(f"User {user_id} отказался завершать диалог с {initiator_id}.")
-                try:
-                    await bot.send_message(
-                        initiator_id,
-                        "➡️ Собеседник решил продолжить диалог.",
-                        reply_markup=dialog_keyboard
-                    )
-                    await message.answer(
-                        "➡️ Диалог продолжается.",
-                        reply_markup=dialog_keyboard
-                    )
-                except Exception as e:
-                    logging.warning(f"Не удалось отправить сообщение об отказе завершения обоим {initiator_id}/{user_id}: {e}")
-
-                user_states[user_id]['step'] = 'dialog'
-                user_states[initiator_id]['step'] = 'dialog'
-                if initiator_id in pending_shutdowns:
-                    del pending_shutdowns[initiator_id]
-                return
-            else:
-                await message.answer("Пожалуйста, используйте кнопки для подтверждения или отказа.", reply_markup=shutdown_request_keyboard)
-                return
-        else:
-            await message.answer("Нет активного запроса на завершение диалога от вас.", reply_markup=main_menu)
-            user_states[user_id] = {"step": "idle"}
+            app.cancel_shutdown_timeout(initiator_id)
+            await app.sessions.resolve_shutdown(initiator_id, user_id, "idle")
             return
-    
-    # Пользователь, который запросил завершение и ждет подтверждения (initiator_id)
-    if state["step"] == "awaiting_shutdown_confirmation":
-        await message.answer("⏳ Вы уже запросили завершение диалога. Ожидаем подтверждения от собеседника.")
-        return
 
-    # --- Логика поддержки ---
-    if state["step"] == "support_message":
-        if ADMIN_ID != 0: # Проверяем, что ADMIN_ID установлен
+        elif text == "❌ Продолжить общение":
+            logging.info("User %s отказался завершать диалог с %s.", user_id, initiator_id, extra={"user_id": user_id, "target_id": initiator_id})
             try:
-                await bot.send_message(ADMIN_ID, f"📬 Запрос в поддержку:\nОт: @{message.from_user.username if message.from_user.username else user_id}\nID: {user_id}\nСообщение: {text}")
-                await message.answer("Спасибо, ваш запрос передан! Мы свяжемся с вами при необходимости.", reply_markup=main_menu)
-                user_states[user_id] = {"step": "idle"}
-                logging.info(f"Запрос в поддержку от {user_id} отправлен админу.")
+                await app.outbound.send_message(
+                    initiator_id,
+                    "➡️ Собеседник решил продолжить диалог.",
+                    reply_markup=dialog_keyboard
+                )
+                await message.answer(
+                    "➡️ Диалог продолжается.",
+                    reply_markup=dialog_keyboard
+                )
             except Exception as e:
-                logging.error(f"Не удалось отправить запрос в поддержку админу {ADMIN_ID}: {e}")
-                await message.answer("Не удалось отправить ваш запрос в поддержку. Произошла ошибка.", reply_markup=main_menu)
-                user_states[user_id] = {"step": "idle"}
+                logging.warning("Не удалось отправить сообщение об отказе завершения обоим %s/%s: %s", initiator_id, user_id, e, extra={"user_id": user_id})
+
+            app.cancel_shutdown_timeout(initiator_id)
+            await app.sessions.resolve_shutdown(initiator_id, user_id, "dialog")
+            return
         else:
-            await message.answer("Функция поддержки временно недоступна (не настроен ID администратора).", reply_markup=main_menu)
-            user_states[user_id] = {"step": "idle"}
-        return
+            await message.answer("Пожалуйста, используйте кнопки для подтверждения или отказа.", reply_markup=shutdown_request_keyboard)
+            return
+    else:
+        await message.answer("Нет активного запроса на завершение диалога от вас.", reply_markup=main_menu)
+        await app.sessions.set_state(user_id, {"step": "idle"})
 
-    # --- Логика регистрации (продолжение) ---
-    elif state["step"] == "awaiting_car_number":
-        car_number = text.upper().replace(" ", "")
+# Пользователь, который запросил завершение и ждет подтверждения (initiator_id)
+@router.step("awaiting_shutdown_confirmation")
+async def on_awaiting_shutdown_confirmation(message: Message, state: dict, text: str, app: App):
+    await message.answer("⏳ Вы уже запросили завершение диалога. Ожидаем подтверждения от собеседника.")
+
+# --- Логика поддержки ---
+@router.step("support_message")
+async def on_support_message(message: Message, state: dict, text: str, app: App):
+    user_id = message.from_user.id
+    if app.settings.admin_id != 0: # Проверяем, что ADMIN_ID установлен
         try:
-            supabase.table("users").update({"car_number": car_number}).eq("telegram_id", user_id).execute()
-            user_states[user_id] = {**state, "car_number": car_number, "step": "awaiting_allow_direct"}
-            await message.answer("Разрешаете другим пользователям писать вам в ЛС?", reply_markup=allow_direct_keyboard)
-            logging.info(f"User {user_id} ввел номер авто {car_number}. Ожидаем разрешение ЛС.")
+            ticket_id = await app.support.open_ticket(message)
+            await message.answer(
+                f"Спасибо, ваш запрос передан (обращение #{ticket_id})! Ответ поддержки придёт в этот чат.",
+                reply_markup=main_menu
+            )
+            await app.sessions.set_state(user_id, {"step": "idle"})
+            logging.info("Запрос в поддержку от %s отправлен админу, обращение #%s.", user_id, ticket_id, extra={"user_id": user_id})
         except Exception as e:
-            logging.error(f"Ошибка при обновлении car_number для пользователя {user_id}: {e}")
-            await message.answer("Произошла ошибка при сохранении номера авто. Пожалуйста, попробуйте еще раз.", reply_markup=main_menu)
-            user_states[user_id] = {"step": "idle"}
+            logging.error("Не удалось отправить запрос в поддержку админу %s: %s", app.settings.admin_id, e)
+            await message.answer("Не удалось отправить ваш запрос в поддержку. Произошла ошибка.", reply_markup=main_menu)
+            await app.sessions.set_state(user_id, {"step": "idle"})
+    else:
+        await message.answer("Функция поддержки временно недоступна (не настроен ID администратора).", reply_markup=main_menu)
+        await app.sessions.set_state(user_id, {"step": "idle"})
+
+# --- Логика регистрации (продолжение) ---
+@router.step("awaiting_car_number")
+async def on_awaiting_car_number(message: Message, state: dict, text: str, app: App):
+    user_id = message.from_user.id
+    car_number = normalize_plate(text)
+    try:
+        await app.users_repo.update(user_id, {"car_number": car_number})
+        await app.sessions.set_state(user_id, {**state, "car_number": car_number, "step": "awaiting_allow_direct"})
+        await message.answer("Разрешаете другим пользователям писать вам в ЛС?", reply_markup=allow_direct_keyboard)
+        logging.info("User %s ввел номер авто %s. Ожидаем разрешение ЛС.", user_id, car_number, extra={"user_id": user_id})
+    except Exception as e:
+        logging.error("Ошибка при обновлении car_number для пользователя %s: %s", user_id, e, extra={"user_id": user_id})
+        await message.answer("Произошла ошибка при сохранении номера авто. Пожалуйста, попробуйте еще раз.", reply_markup=main_menu)
+        await app.sessions.set_state(user_id, {"step": "idle"})
+
+@router.step("awaiting_allow_direct")
+async def on_awaiting_allow_direct(message: Message, state: dict, text: str, app: App):
+    user_id = message.from_user.id
+    allow_direct = text.lower() in ["да", "yes"]
+    if text.lower() not in ["да", "yes", "нет", "no"]:
+        await message.answer("Пожалуйста, выберите 'Да' или 'Нет'.", reply_markup=allow_direct_keyboard)
         return
+    try:
+        await app.users_repo.update(user_id, {"verified": True, "allow_direct": allow_direct})
+        await message.answer("Регистрация завершена ✅", reply_markup=main_menu)
+        await app.sessions.set_state(user_id, {"step": "idle"})
+        logging.info("User %s завершил регистрацию. allow_direct: %s.", user_id, allow_direct, extra={"user_id": user_id})
+    except Exception as e:
+        logging.error("Ошибка при обновлении allow_direct для пользователя %s: %s", user_id, e, extra={"user_id": user_id})
+        await message.answer("Произошла ошибка при завершении регистрации. Пожалуйста, попробуйте еще раз.", reply_markup=main_menu)
+        await app.sessions.set_state(user_id, {"step": "idle"})
+
+# --- Логика поиска и начала диалога ---
+@router.step("search_car")
+async def on_search_car(message: Message, state: dict, text: str, app: App):
+    user_id = message.from_user.id
+    car_number_to_search = normalize_plate(text)
+    logging.info("User %s ищет номер авто: %s", user_id, car_number_to_search, extra={"user_id": user_id})
+
+    # Сначала ищем в Supabase
+    target_user = await app.users_repo.get_by_car_number(car_number_to_search)
 
-    elif state["step"] == "awaiting_allow_direct":
-        allow_direct = text.lower() in ["да", "yes"]
-        if text.lower() not in ["да", "yes", "нет", "no"]:
-            await message.answer("Пожалуйста, выберите 'Да' или 'Нет'.", reply_markup=allow_direct_keyboard)
+    source = "supabase"
+    if not target_user and state.get("suggested_for") != car_number_to_search:
+        # Возможно, опечатка: предлагаем похожие известные номера. Повторный ввод того же номера идёт в Himera
+        suggestions = app.users_repo.suggest_car_numbers(car_number_to_search)
+        if suggestions:
+            await message.answer(
+                "Номер не найден. Возможно, вы имели в виду: " + ", ".join(suggestions) + "\n"
+                "Введите номер ещё раз или отправьте тот же номер, чтобы продолжить поиск.",
+                reply_markup=ReplyKeyboardRemove()
+            )
+            await app.sessions.set_state(user_id, {"step": "search_car", "suggested_for": car_number_to_search})
+            logging.info("User %s: номер %s не найден, предложены %s.", user_id, car_number_to_search, suggestions, extra={"user_id": user_id})
             return
-        try:
-            supabase.table("users").update({"verified": True, "allow_direct": allow_direct}).eq("telegram_id", user_id).execute()
-            await message.answer("Регистрация завершена ✅", reply_markup=main_menu)
-            user_states[user_id] = {"step": "idle"}
-            logging.info(f"User {user_id} завершил регистрацию. allow_direct: {allow_direct}.")
-        except Exception as e:
-            logging.error(f"Ошибка при обновлении allow_direct для пользователя {user_id}: {e}")
-            await message.answer("Произошла ошибка при завершении регистрации. Пожалуйста, попробуйте еще раз.", reply_markup=main_menu)
-            user_states[user_id] = {"step": "idle"}
-        return
 
-    # --- Логика поиска и начала диалога ---
-    elif state["step"] == "search_car":
-        car_number_to_search = text.upper().replace(" ", "")
-        logging.info(f"User {user_id} ищет номер авто: {car_number_to_search}")
-
-        # Сначала ищем в Supabase
-        result = supabase.table("users").select("*").eq("car_number", car_number_to_search).execute()
-        target_user = result.data[0] if result.data else None
-        
-        source = "supabase"
-        if not target_user:
-            logging.info(f"Авто {car_number_to_search} не найден в Supabase, пробуем Himera.")
-            himera_data = await search_himera(car_number_to_search)
-            if himera_data:
-                # Если нашли в Himera, проверяем, есть ли такой car_number уже, чтобы не дублировать
-                existing_user_by_himera_car = supabase.table("users").select("*").eq("car_number", new_car_number).execute().data # И здесь используем new_car_number
-                if existing_user_by_himera_car:
-                    target_user = existing_user_by_himera_car[0]
-                    source = "supabase_from_himera_existing"
-                    logging.info(f"Авто {car_number_to_search} найден через Himera, но уже есть в Supabase.")
-                else:
-                    new_car_number = himera_data.get("car_number", "").upper().replace(" ", "") # Добавляем .upper() и .replace(" ", "")
-                    new_user = {
-                        "car_number": new_car_number, # Используем очищенный и приведенный к верхнему регистру номер
-                        "username": himera_data.get("telegram"), # Himera может возвращать username
-                        "phone_number": himera_data.get("phone"),
-                        "verified": False,
-                        "allow_direct": False, # По умолчанию false для Himera-найденных
-                        "source": "himera",
-                        "telegram_id": None # ID телеграма неизвестен
-                    }
-                    try:
-                        inserted_data = supabase.table("users").insert(new_user).execute()
-                        target_user = inserted_data.data[0] # Получаем вставленного пользователя с его ID в Supabase
-                        source = "himera_new"
-                        logging.info(f"Авто {car_number_to_search} найден через Himera и добавлен в Supabase.")
-                    except Exception as e:
-                        logging.error(f"Ошибка при добавлении пользователя из Himera в Supabase: {e}")
-                        target_user = None # Если ошибка, считаем, что не нашли
+    if not target_user:
+        # Запрос в Himera платный: у каждого пользователя свой лимит. Ответ из кэша лимит не расходует
+        if app.himera.needs_request(car_number_to_search):
+            retry_after = await app.throttle.hit(user_id, "himera")
+            if retry_after:
+                await message.answer(
+                    f"⏳ Лимит поиска по внешней базе исчерпан. Попробуйте через {format_wait(retry_after)}.",
+                    reply_markup=main_menu
+                )
+                await app.sessions.set_state(user_id, {"step": "idle"})
+                return
+        logging.info("Авто %s не найден в Supabase, пробуем Himera.", car_number_to_search)
+        himera_data = await app.himera.lookup(car_number_to_search)
+        if himera_data:
+            new_car_number = normalize_plate(himera_data.get("car_number") or car_number_to_search)
+            # Himera может вернуть номер в другом написании — проверяем, нет ли его уже в базе, чтобы не дублировать
+            existing_user_by_himera_car = None
+            if new_car_number != car_number_to_search:
+                existing_user_by_himera_car = await app.users_repo.get_by_car_number(new_car_number)
+            if existing_user_by_himera_car:
+                target_user = existing_user_by_himera_car
+                source = "supabase_from_himera_existing"
+                logging.info("Авто %s найден через Himera, но уже есть в Supabase.", car_number_to_search)
             else:
-                logging.info(f"Авто {car_number_to_search} не найден ни в Supabase, ни в Himera.")
+                target_user = {
+                    "car_number": new_car_number,
+                    "username": himera_data.get("telegram"), # Himera может возвращать username
+                    "phone_number": himera_data.get("phone"),
+                    "verified": False,
+                    "allow_direct": False, # По умолчанию false для Himera-найденных
+                    "source": "himera",
+                    "telegram_id": None # ID телеграма неизвестен
+                }
+                # Запись в Supabase уходит в фоновую пачку, ответ пользователю её не ждёт
+                app.himera_writes.add(target_user)
+                source = "himera_new"
+                logging.info("Авто %s найден через Himera, запись в Supabase поставлена в очередь.", car_number_to_search)
+        else:
+            logging.info("Авто %s не найден ни в Supabase, ни в Himera.", car_number_to_search)
 
-        if target_user:
-            target_id = target_user.get("telegram_id")
-            allow_direct = target_user.get("allow_direct", False)
-            username = target_user.get("username")
-            target_car_number = target_user.get("car_number", "неизвестен")
+    if target_user:
+        target_id = target_user.get("telegram_id")
+        allow_direct = target_user.get("allow_direct", False)
+        username = target_user.get("username")
+        target_car_number = target_user.get("car_number", "неизвестен")
 
-            current_user_data = supabase.table("users").select("car_number").eq("telegram_id", user_id).execute()
-            sender_car_number = current_user_data.data[0].get("car_number") if current_user_data.data else "неизвестен"
+        current_user_data = await app.users_repo.get_by_telegram_id(user_id)
+        sender_car_number = current_user_data.get("car_number") if current_user_data else "неизвестен"
 
-            # Нельзя начать диалог с самим собой
-            if target_id == user_id:
-                await message.answer("Вы не можете начать диалог с самим собой.", reply_markup=main_menu)
-                user_states[user_id] = {"step": "idle"}
-                return
+        # Нельзя начать диалог с самим собой
+        if target_id == user_id:
+            await message.answer("Вы не можете начать диалог с самим собой.", reply_markup=main_menu)
+            await app.sessions.set_state(user_id, {"step": "idle"})
+            return
 
-            # Если пользователь найден и разрешил прямые сообщения
-            if target_id and allow_direct:
-                if username:
-                    await message.answer(f"Пользователь найден: @{username}\nВы можете написать ему напрямую.", reply_markup=main_menu)
-                else:
-                    await message.answer(f"Пользователь найден (ID: {target_id}). Он разрешил прямые сообщения. Вы можете попробовать найти его через ID или подождать, пока он сам напишет.", reply_markup=main_menu)
-                user_states[user_id] = {"step": "idle"}
-                logging.info(f"User {user_id} найден {target_id}, разрешены прямые сообщения. Диалог не требуется.")
-            # Если пользователь найден, но не разрешил прямые сообщения, или его telegram_id неизвестен (найден через Himera)
-            elif target_id: # Пользователь зарегистрирован в боте, но не разрешил прямые сообщения
-                # Проверяем, не находится ли target_id уже в диалоге с кем-то
-                target_state = user_states.get(target_id, {"step": "idle"})
+        # Если пользователь найден и разрешил прямые сообщения
+        if target_id and allow_direct:
+            if username:
+                await message.answer(f"Пользователь найден: @{username}\nВы можете написать ему напрямую.", reply_markup=main_menu)
+            else:
+                await message.answer(f"Пользователь найден (ID: {target_id}). Он разрешил прямые сообщения. Вы можете попробовать найти его через ID или подождать, пока он сам напишет.", reply_markup=main_menu)
+            await app.sessions.set_state(user_id, {"step": "idle"})
+            logging.info("User %s найден %s, разрешены прямые сообщения. Диалог не требуется.", user_id, target_id, extra={"user_id": user_id, "target_id": target_id})
+        # Если пользователь найден, но не разрешил прямые сообщения, или его telegram_id неизвестен (найден через Himera)
+        elif target_id: # Пользователь зарегистрирован в боте, но не разрешил прямые сообщения
+            # Проверка занятости и запись диалога идут под замком цели: второй поиск того же владельца
+            # и его собственные обновления их не перехватят. Замок ждём недолго: владелец может как раз
+            # обрабатывать своё сообщение, а бессрочное ожидание заблокировало бы двух пользователей,
+            # одновременно ищущих друг друга
+            async with app.user_locks.hold_within(target_id, DIALOG_CLAIM_TIMEOUT) as claimed:
+                if not claimed:
+                    await message.answer("Не удалось начать диалог прямо сейчас. Попробуйте ещё раз.", reply_markup=main_menu)
+                    await app.sessions.set_state(user_id, {"step": "idle"})
+                    logging.info("User %s не дождался замка %s для начала диалога.", user_id, target_id, extra={"user_id": user_id, "target_id": target_id})
+                    return
+                target_state = await app.sessions.get_state(target_id)
                 if target_state.get("step") in ["awaiting_first_message", "dialog", "awaiting_shutdown_confirmation", "shutdown_requested"]:
                     await message.answer(f"Владелец авто {target_car_number} сейчас уже занят в другом диалоге. Пожалуйста, попробуйте позже.", reply_markup=main_menu)
-                    user_states[user_id] = {"step": "idle"}
-                    logging.info(f"User {user_id} попытался начать диалог с {target_id}, но тот занят.")
+                    await app.sessions.set_state(user_id, {"step": "idle"})
+                    logging.info("User %s попытался начать диалог с %s, но тот занят.", user_id, target_id, extra={"user_id": user_id, "target_id": target_id})
                     return
 
-                user_states[user_id] = {
-                    "step": "awaiting_first_message", # Инициатор ждет подтверждения
-                    "target_id": target_id,
-                    "sender_car_number": sender_car_number,
-                    "target_car_number": target_car_number
-                }
-                user_states[target_id] = {
-                    "step": "dialog", # Цель сразу в состоянии диалога, как только примет первое сообщение
-                    "target_id": user_id,
-                    "sender_car_number": target_car_number, # Для цели отправитель - это car_number инициатора
-                    "target_car_number": sender_car_number # Для цели цель - это ее собственный car_number
-                }
+                retry_after = await app.throttle.hit(user_id, "dialog_start")
+                if retry_after:
+                    await message.answer(f"⏳ Слишком много новых диалогов. Попробуйте через {format_wait(retry_after)}.", reply_markup=main_menu)
+                    await app.sessions.set_state(user_id, {"step": "idle"})
+                    logging.info("User %s превысил лимит начала диалогов.", user_id, extra={"user_id": user_id})
+                    return
 
-                await message.answer(
-                    f"🔹 Начинаем диалог с владельцем авто {target_car_number}.\n"
-                    "Напишите ваше первое сообщение:",
+                dialog_id = await app.sessions.start_dialog(user_id, target_id, sender_car_number, target_car_number)
+
+            await message.answer(
+                f"🔹 Начинаем диалог с владельцем авто {target_car_number}.\n"
+                "Напишите ваше первое сообщение:",
+                reply_markup=dialog_keyboard
+            )
+
+            # Сообщаем целевому пользователю о входящем диалоге
+            try:
+                await app.outbound.send_message(
+                    target_id,
+                    f"🔹 Владелец авто {sender_car_number} хочет начать с вами диалог.\n"
+                    "Ожидайте первое сообщение...",
                     reply_markup=dialog_keyboard
                 )
-                
-                # Сообщаем целевому пользователю о входящем диалоге
-                try:
-                    await bot.send_message(
-                        target_id,
-                        f"🔹 Владелец авто {sender_car_number} хочет начать с вами диалог.\n"
-                        "Ожидайте первое сообщение...",
-                        reply_markup=dialog_keyboard
-                    )
-                    logging.info(f"User {user_id} начал диалог с {target_id}. Ожидается первое сообщение.")
-                except Exception as e:
-                    logging.error(f"Не удалось уведомить пользователя {target_id} о начале диалога от {user_id}: {e}")
-                    await message.answer("Не удалось начать диалог с этим пользователем. Возможно, он заблокировал бота.", reply_markup=main_menu)
-                    user_states[user_id] = {"step": "idle"}
-                    del user_states[target_id] # Удаляем временное состояние
-            else: # Пользователь не найден или найден через Himera, но без telegram_id
-                await message.answer("Пользователь не найден в системе или его telegram_id неизвестен.", reply_markup=main_menu)
-                user_states[user_id] = {"step": "idle"}
-                logging.info(f"User {user_id} не смог найти пользователя {car_number_to_search} для диалога.")
-        else:
-            await message.answer("Пользователь не найден даже через Himera.", reply_markup=main_menu)
-            user_states[user_id] = {"step": "idle"}
-            logging.info(f"User {user_id} не смог найти пользователя {car_number_to_search} вообще.")
-        return
+                logging.info("User %s начал диалог %s с %s. Ожидается первое сообщение.", user_id, dialog_id, target_id, extra={"user_id": user_id, "dialog_id": dialog_id, "target_id": target_id})
+            except Exception as e:
+                logging.error("Не удалось уведомить пользователя %s о начале диалога от %s: %s", target_id, user_id, e, extra={"target_id": target_id, "user_id": user_id})
+                await message.answer("Не удалось начать диалог с этим пользователем. Возможно, он заблокировал бота.", reply_markup=main_menu)
+                await app.sessions.commit(states={user_id: {"step": "idle"}, target_id: None}) # Удаляем временное состояние
+        else: # Пользователь не найден или найден через Himera, но без telegram_id
+            await message.answer("Пользователь не найден в системе или его telegram_id неизвестен.", reply_markup=main_menu)
+            await app.sessions.set_state(user_id, {"step": "idle"})
+            logging.info("User %s не смог найти пользователя %s для диалога.", user_id, car_number_to_search, extra={"user_id": user_id})
+    else:
+        await message.answer("Пользователь не найден даже через Himera.", reply_markup=main_menu)
+        await app.sessions.set_state(user_id, {"step": "idle"})
+        logging.info("User %s не смог найти пользователя %s вообще.", user_id, car_number_to_search, extra={"user_id": user_id})
 
-    # --- Логика пересылки сообщений в активном диалоге ---
-    elif state["step"] == "awaiting_first_message" or state["step"] == "dialog":
-        target_id = state.get("target_id")
-        if not target_id:
-            await message.answer("❌ Ошибка: получатель не найден для продолжения диалога.", reply_markup=main_menu)
-            user_states[user_id] = {"step": "idle"}
-            logging.warning(f"User {user_id} в состоянии {state['step']}, но target_id отсутствует.")
-            return
+# --- Логика пересылки сообщений в активном диалоге ---
+@router.step("awaiting_first_message", "dialog")
+async def on_dialog_message(message: Message, state: dict, text: str, app: App, album: list = None):
+    user_id = message.from_user.id
+    target_id = state.get("target_id")
+    if not target_id:
+        await message.answer("❌ Ошибка: получатель не найден для продолжения диалога.", reply_markup=main_menu)
+        await app.sessions.set_state(user_id, {"step": "idle"})
+        logging.warning("User %s в состоянии %s, но target_id отсутствует.", user_id, state['step'], extra={"user_id": user_id, "step": state['step']})
+        return
 
-        # Проверяем, что целевой пользователь также находится в диалоге с текущим
-        target_state = user_states.get(target_id)
-        if not target_state or target_state.get("target_id") != user_id or target_state.get("step") not in ["awaiting_first_message", "dialog"]:
-            await message.answer("❌ Собеседник вышел из диалога или его состояние некорректно. Диалог завершен.", reply_markup=main_menu)
-            user_states[user_id] = {"step": "idle"}
-            logging.warning(f"User {user_id} пытался отправить сообщение, но состояние {target_id} не позволяет. target_state: {target_state}")
-            return
+    # Проверяем, что целевой пользователь также находится в диалоге с текущим
+    target_state = await app.sessions.find_state(target_id)
+    if not target_state or target_state.get("target_id") != user_id or target_state.get("dialog_id") != state.get("dialog_id") or target_state.get("step") not in ["awaiting_first_message", "dialog"]:
+        await message.answer("❌ Собеседник вышел из диалога или его состояние некорректно. Диалог завершен.", reply_markup=main_menu)
+        await app.sessions.set_state(user_id, {"step": "idle"})
+        logging.warning("User %s пытался отправить сообщение, но состояние %s не позволяет. target_state: %s", user_id, target_id, target_state, extra={"user_id": user_id, "target_id": target_id})
+        return
 
+    header = f"📩 Сообщение от владельца авто {state.get('sender_car_number', 'неизвестен')}:"
+    try:
+        # Отправляем сообщение получателю (пересылка в диалоге идёт вперёд уведомлений).
+        # Медиа копируется по file_id, без скачивания и повторной загрузки
+        for method in relay_methods(message, target_id, header, dialog_keyboard, album):
+            await app.outbound.send(method, PRIORITY_RELAY)
+        # Подтверждение отправителю ставим в очередь, не дожидаясь отправки
+        app.outbound.submit_message(
+            user_id,
+            "✅ Сообщение доставлено!",
+            priority=PRIORITY_RELAY,
+            reply_markup=dialog_keyboard
+        )
+        # Убеждаемся, что оба в состоянии 'dialog'
+        if state["step"] != "dialog" or target_state["step"] != "dialog":
+            await app.sessions.commit(states={user_id: {**state, "step": "dialog"}, target_id: {**target_state, "step": "dialog"}})
+        message_log.info("Сообщение от %s к %s доставлено.", user_id, target_id, extra={"user_id": user_id, "target_id": target_id, "dialog_id": state.get("dialog_id")})
+    except TelegramBadRequest as e:
+        # Этот тип сообщения скопировать нельзя (например, опрос-викторину) — диалог продолжается
+        logging.warning("Не удалось переслать сообщение типа %s от %s к %s: %s", message.content_type, user_id, target_id, e, extra={"user_id": user_id, "target_id": target_id})
+        await message.answer("❌ Такое сообщение переслать не получилось. Попробуйте отправить его иначе.", reply_markup=dialog_keyboard)
+    except TelegramRetryAfter as e:
+        # Очередь исчерпала повторы на лимите Telegram (OUTBOUND_MAX_ATTEMPTS): собеседник доступен, диалог продолжается
+        logging.warning("Лимит Telegram при пересылке от %s к %s, повтор через %s с.", user_id, target_id, e.retry_after, extra={"user_id": user_id, "target_id": target_id})
+        await message.answer(
+            f"⏳ Сообщение не доставлено: Telegram временно ограничил отправку. Попробуйте через {format_wait(e.retry_after)}.",
+            reply_markup=dialog_keyboard
+        )
+    except Exception as e:
+        logging.error("Ошибка отправки сообщения от %s к %s: %s", user_id, target_id, e, extra={"user_id": user_id, "target_id": target_id})
+        await message.answer(
+            "❌ Не удалось отправить сообщение. Возможно, пользователь заблокировал бота или произошла другая ошибка.",
+            reply_markup=main_menu
+        )
+        # Завершаем диалог для обоих, если произошла ошибка отправки
+        await app.sessions.end_dialog(user_id, target_id)
         try:
-            # Отправляем сообщение получателю
-            await bot.send_message(
-                target_id,
-                f"📩 Сообщение от владельца авто {state.get('sender_car_number', 'неизвестен')}:\n\n{text}",
-                reply_markup=dialog_keyboard
-            )
-            # Подтверждение отправителю
-            await message.answer(
-                "✅ Сообщение доставлено!",
-                reply_markup=dialog_keyboard
-            )
-            # Убеждаемся, что оба в состоянии 'dialog'
-            user_states[user_id]['step'] = 'dialog'
-            user_states[target_id]['step'] = 'dialog'
-            logging.info(f"Сообщение от {user_id} к {target_id} доставлено. Оба в 'dialog' состоянии.")
-        except Exception as e:
-            logging.error(f"Ошибка отправки сообщения от {user_id} к {target_id}: {e}")
-            await message.answer(
-                "❌ Не удалось отправить сообщение. Возможно, пользователь заблокировал бота или произошла другая ошибка.",
-                reply_markup=main_menu
-            )
-            # Завершаем диалог для обоих, если произошла ошибка отправки
-            user_states[user_id] = {"step": "idle"}
-            if target_id in user_states:
-                user_states[target_id] = {"step": "idle"}
-            try:
-                await bot.send_message(target_id, "❌ Диалог завершен из-за ошибки отправки сообщения.")
-            except:
-                pass # Игнорируем ошибку, если не удалось отправить сообщение target_id
-            logging.info(f"Диалог между {user_id} и {target_id} завершен из-за ошибки отправки.")
+            await app.outbound.send_message(target_id, "❌ Диалог завершен из-за ошибки отправки сообщения.")
+        except:
+            pass # Игнорируем ошибку, если не удалось отправить сообщение target_id
+        logging.info("Диалог между %s и %s завершен из-за ошибки отправки.", user_id, target_id, extra={"user_id": user_id, "target_id": target_id})
+
+# --- Дефолтная реакция ---
+@router.default
+async def on_unknown_step(message: Message, state: dict, text: str, app: App):
+    user_id = message.from_user.id
+    await message.answer("Выберите действие из меню:", reply_markup=main_menu)
+    await app.sessions.set_state(user_id, {"step": "idle"})
+    logging.info("User %s в неизвестном состоянии '%s'. Сброс на 'idle'.", user_id, state['step'], extra={"user_id": user_id, "step": state['step']})
+
+async def handle_message(message: Message, app: App, user_state: dict = None, album: list = None):
+    user_id = message.from_user.id
+    text = (message.text or "").strip()
+    # Состояние уже прочитано под замком пользователя (см. UserSerializationMiddleware)
+    state = user_state or dict(IDLE)
+
+    # Фото, стикеры, геопозиция и т.п. пересылаются только внутри диалога, на остальных шагах нужен текст
+    if message.text is None and state["step"] not in DIALOG_STEPS:
+        await message.answer("Пожалуйста, отправьте текстовое сообщение.")
         return
 
-    # --- Дефолтная реакция ---
-    else:
-        await message.answer("Выберите действие из меню:", reply_markup=main_menu)
-        user_states[user_id] = {"step": "idle"}
-        logging.info(f"User {user_id} в неизвестном состоянии '{state['step']}'. Сброс на 'idle'.")
+    # Кнопки меню имеют приоритет над текущим шагом, дальше — обработчик шага
+    route = router.resolve(text, state["step"])
+    started = time.monotonic()
+    with app.step_timing.measure(state["step"]), app.handler_timing.stats.measure(f"route:{route.name}"):
+        if album is not None:
+            # Альбом пересылается собеседнику одним сообщением (см. AlbumMiddleware)
+            await on_dialog_message(message, state, text, app, album)
+        else:
+            await route.handler(message, state, text, app)
+    message_log.info(
+        "User %s: шаг %s, обработчик %s", user_id, state["step"], route.name,
+        extra={
+            "user_id": user_id,
+            "step": state["step"],
+            "route": route.name,
+            "dialog_id": state.get("dialog_id"),
+            "latency_ms": round((time.monotonic() - started) * 1000, 1),
+        },
+    )
+
+# --- Фабрики ---
+def create_app(settings: Settings = None) -> App:
+    # Компоненты бота без подключений: клиенты и фоновые задачи запускаются в App.on_startup
+    return App(settings or Settings.from_env())
+
+def create_bot(settings: Settings) -> Bot:
+    settings.validate()
+    return Bot(token=settings.bot_token)
+
+def create_handlers(admin_id: int) -> Router:
+    # Новый роутер на каждый вызов: роутер можно подключить только к одному диспетчеру
+    handlers = Router(name="carbot")
+    admin = F.from_user.id == admin_id
+    handlers.message.register(start, CommandStart())
+    handlers.message.register(stats_handler, Command("stats"), admin)
+    handlers.message.register(tickets_handler, Command("tickets"), admin)
+    handlers.message.register(broadcast_handler, Command("broadcast"), admin)
+    handlers.message.register(broadcast_status_handler, Command("broadcast_status"), admin)
+    handlers.message.register(broadcast_resume_handler, Command("broadcast_resume"), admin)
+    handlers.message.register(broadcast_stop_handler, Command("broadcast_stop"), admin)
+    handlers.message.register(support_reply_handler, support_thread)
+    handlers.message.register(contact_handler, registration_contact)
+    handlers.message.register(handle_message)
+    return handlers
+
+def create_dispatcher(app: App) -> Dispatcher:
+    # app попадает в обработчики, фильтры и хуки запуска по имени аргумента (workflow_data диспетчера)
+    dp = Dispatcher(app=app)
+    dp.update.outer_middleware(app.inflight)
+    # Части альбома собираются в одно обновление до очереди по пользователю
+    dp.update.outer_middleware(AlbumMiddleware(app.settings.media_group_wait))
+    # Обновления одного пользователя (и пары собеседников) не обрабатываются одновременно
+    dp.update.outer_middleware(UserSerializationMiddleware(app.user_locks, app.sessions.find_state))
+    # После каждого обновления (ещё под замком пользователя) переносим таймер неактивности его сессии
+    dp.update.outer_middleware(ActivityMiddleware(app.on_user_activity))
+    # Частые поиски отклоняются до обработчиков, ещё под замком пользователя
+    dp.message.outer_middleware(ThrottleMiddleware(app.throttle, throttled_action, on_throttled))
+    dp.message.middleware(app.handler_timing)
+    dp.include_router(create_handlers(app.settings.admin_id))
+    dp.startup.register(app.on_startup)
+    dp.shutdown.register(app.on_shutdown)
+    return dp
 
 async def main():
-    logging.info("Starting bot polling...")
-    await on_startup()
-    await dp.start_polling(bot)
+    settings = Settings.from_env()
+    setup_logging(settings.log_level, settings.log_format, settings.log_message_sample_rate)
+    app = create_app(settings)
+    bot = create_bot(app.settings)
+    dp = create_dispatcher(app)
+    if app.settings.run_mode == "webhook":
+        logging.info("Starting bot webhook server...")
+        await run_webhook(
+            dp, bot, app.settings.webhook_url, app.settings.webhook_path, app.settings.webhook_secret,
+            app.settings.webapp_host, app.settings.webapp_port
+        )
+    else:
+        logging.info("Starting bot polling...")
+        await bot.delete_webhook() # getUpdates не работает, пока установлен webhook
+        await dp.start_polling(bot)
 
 if __name__ == "__main__":
     asyncio.run(main())
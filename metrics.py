@@ -0,0 +1,97 @@
+import inspect
+import logging
+
+from aiohttp import web
+
+from stats import LatencyStats
+
+# Локальный HTTP-сервер с /metrics в текстовом формате Prometheus. METRICS_PORT=0 отключает сервер
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9090
+
+
+class MetricsRegistry:
+    # Метрики не хранятся отдельно: при каждом запросе значения читаются из уже существующих счётчиков
+    # (LatencyStats, очередь отправки, хранилище состояний)
+    def __init__(self, prefix: str = "carbot"):
+        self.prefix = prefix
+        self._collectors = []
+
+    def counter(self, name: str, help_text: str, value):
+        self._collectors.append((self._scalar, name, help_text, "counter", value))
+
+    def gauge(self, name: str, help_text: str, value):
+        # value — функция без аргументов, может быть корутиной
+        self._collectors.append((self._scalar, name, help_text, "gauge", value))
+
+    def histogram(self, name: str, help_text: str, stats: LatencyStats, label: str):
+        # Гистограмма задержек по операциям LatencyStats плюс счётчик ошибок <name>_errors_total
+        self._collectors.append((self._histogram, name, help_text, label, stats))
+
+    async def render(self) -> str:
+        lines = []
+        for collect, name, help_text, *args in self._collectors:
+            try:
+                lines += await collect(f"{self.prefix}_{name}", help_text, *args)
+            except Exception as e:
+                logging.warning("Не удалось собрать метрику %s: %s", name, e)
+        return "\n".join(lines) + "\n"
+
+    async def _scalar(self, name: str, help_text: str, kind: str, value):
+        result = value()
+        if inspect.isawaitable(result):
+            result = await result
+        return [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {_number(result)}"]
+
+    async def _histogram(self, name: str, help_text: str, label: str, stats: LatencyStats):
+        histograms = stats.histograms()
+        lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        for key, data in histograms.items():
+            labels = f'{label}="{_escape(key)}"'
+            for le, count in data["buckets"]:
+                lines.append(f'{name}_bucket{{{labels},le="{_number(le)}"}} {count}')
+            lines.append(f"{name}_sum{{{labels}}} {_number(data['sum'])}")
+            lines.append(f"{name}_count{{{labels}}} {data['count']}")
+        errors = f"{name.removesuffix('_seconds')}_errors_total"
+        lines += [f"# HELP {errors} Количество ошибок, учтённых в {name}", f"# TYPE {errors} counter"]
+        for key, data in histograms.items():
+            lines.append(f'{errors}{{{label}="{_escape(key)}"}} {data["errors"]}')
+        return lines
+
+
+class MetricsServer:
+    def __init__(self, registry: MetricsRegistry, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        if not self.port or self._runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logging.info("Метрики доступны на http://%s:%s/metrics", self.host, self.port)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=await self.registry.render(), content_type="text/plain", charset="utf-8")
+
+
+def _number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, bool):
+        return str(int(value))
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,178 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import Message, TelegramObject, Update
+
+from locks import KeyedLock
+from stats import LatencyStats
+from throttle import SlidingWindowLimiter
+
+
+class InflightMiddleware(BaseMiddleware):
+    # Считает обновления в обработке, чтобы при остановке дождаться их завершения
+    def __init__(self):
+        self.active = 0
+        self.handled = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        self.active += 1
+        self.handled += 1
+        self._idle.clear()
+        try:
+            return await handler(event, data)
+        finally:
+            self.active -= 1
+            if self.active == 0:
+                self._idle.set()
+
+    async def wait_idle(self, timeout: float):
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning("Не дождались завершения обработчиков за %s с, в работе: %s", timeout, self.active)
+
+
+class AlbumMiddleware(BaseMiddleware):
+    # Telegram присылает альбом отдельными обновлениями с общим media_group_id. Первое обновление ждёт
+    # остальные wait секунд и уходит в обработчик со всем альбомом в data["album"]; остальные поглощаются
+    def __init__(self, wait: float):
+        self.wait = wait
+        self._groups = {}
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        message = event.message if isinstance(event, Update) else None
+        if message is None or message.media_group_id is None:
+            return await handler(event, data)
+        key = (message.chat.id, message.media_group_id)
+        group = self._groups.get(key)
+        if group is not None:
+            group.append(message)
+            return None
+        group = self._groups[key] = [message]
+        try:
+            await asyncio.sleep(self.wait)
+        finally:
+            del self._groups[key]
+        data["album"] = sorted(group, key=lambda item: item.message_id)
+        return await handler(event, data)
+
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    # Замеряет время работы каждого обработчика сообщений (по имени функции)
+    def __init__(self):
+        self.stats = LatencyStats()
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object is not None else "unknown"
+        with self.stats.measure(name):
+            return await handler(event, data)
+
+
+class UserSerializationMiddleware(BaseMiddleware):
+    # Обновления одного пользователя обрабатываются строго по очереди, разных пользователей — параллельно.
+    # Если пользователь в диалоге (target_id в состоянии), берётся и замок собеседника: сообщения с обеих сторон
+    # меняют общее состояние пары. Состояние, прочитанное под замками, кладётся в data["user_state"] (None — сессии нет):
+    # фильтры, следующие middleware и обработчики берут его оттуда, а не читают хранилище заново
+    def __init__(self, locks: KeyedLock, load_state: Callable[[int], Awaitable[Optional[dict]]]):
+        self.locks = locks
+        self.load_state = load_state
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        partner = _partner(await self.load_state(user.id))
+        while True:
+            async with self.locks.hold(user.id, partner):
+                # Пока ждали замки, диалог мог смениться — тогда берём замки заново для нового собеседника
+                state = await self.load_state(user.id)
+                current = _partner(state)
+                if current is None or current == partner:
+                    data["user_state"] = state
+                    return await handler(event, data)
+            partner = current
+
+
+def _partner(state: Optional[dict]) -> Optional[int]:
+    return state.get("target_id") if state else None
+
+
+class ActivityMiddleware(BaseMiddleware):
+    # После обработки обновления сообщает on_activity(user_id), что пользователь активен
+    def __init__(self, on_activity: Callable[[int], Awaitable[None]]):
+        self.on_activity = on_activity
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        try:
+            return await handler(event, data)
+        finally:
+            user = data.get("event_from_user")
+            if user is not None:
+                try:
+                    await self.on_activity(user.id)
+                except Exception as e:
+                    logging.error("Не удалось отметить активность пользователя %s: %s", user.id, e, extra={"user_id": user.id})
+
+
+class ThrottleMiddleware(BaseMiddleware):
+    # Ограничивает частоту действий пользователя до обработчиков сообщений.
+    # classify(message, state) возвращает действие из лимитов SlidingWindowLimiter (например, "search") или None,
+    # state — состояние пользователя из data["user_state"] (см. UserSerializationMiddleware);
+    # сверх лимита обработчик не вызывается, а on_reject(message, retry_after) объясняет пользователю, когда повторить
+    def __init__(
+        self,
+        limiter: SlidingWindowLimiter,
+        classify: Callable[[Message, Optional[dict]], Awaitable[Optional[str]]],
+        on_reject: Callable[[Message, float], Awaitable[None]],
+    ):
+        self.limiter = limiter
+        self.classify = classify
+        self.on_reject = on_reject
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        action = await self.classify(event, data.get("user_state"))
+        if action is not None:
+            retry_after = await self.limiter.hit(event.from_user.id, action)
+            if retry_after:
+                logging.info(
+                    "User %s превысил лимит %s, повтор через %s с.", event.from_user.id, action, retry_after,
+                    extra={"user_id": event.from_user.id, "route": action},
+                )
+                await self.on_reject(event, retry_after)
+                return None
+        return await handler(event, data)
@@ -0,0 +1,15 @@
+-- Каноническая форма номера авто (см. plates.normalize_plate): латиница вместо
+-- кириллических двойников, без пробелов и дефисов, без суффикса RUS и ведущих нулей в коде региона.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS car_number_canonical text;
+
+UPDATE users
+SET car_number_canonical = regexp_replace(
+        regexp_replace(
+            regexp_replace(translate(upper(car_number), 'АВЕКМНОРСТУХ', 'ABEKMHOPCTYX'), '[^0-9A-ZА-ЯЁ]', '', 'g'),
+            'RUS$', ''
+        ),
+        '^([A-Z][0-9]{3}[A-Z]{2})0*([0-9]{2,3})$', '\1\2'
+    )
+WHERE car_number IS NOT NULL;
+
+CREATE INDEX IF NOT EXISTS users_car_number_canonical_idx ON users (car_number_canonical);
@@ -0,0 +1,18 @@
+-- Метка изменения строки для инкрементальной синхронизации справочника номеров (directory.py).
+-- Существующие строки получают текущее время и попадут в первую полную загрузку.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS updated_at timestamptz NOT NULL DEFAULT now();
+
+CREATE OR REPLACE FUNCTION users_touch_updated_at() RETURNS trigger AS $$
+BEGIN
+    NEW.updated_at = clock_timestamp();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS users_touch_updated_at ON users;
+CREATE TRIGGER users_touch_updated_at
+    BEFORE UPDATE ON users
+    FOR EACH ROW EXECUTE FUNCTION users_touch_updated_at();
+
+-- Постраничное чтение по ключу (updated_at, id)
+CREATE INDEX IF NOT EXISTS users_updated_at_id_idx ON users (updated_at, id);
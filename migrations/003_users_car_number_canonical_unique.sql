@@ -0,0 +1,17 @@
+-- Уникальный канонический номер у строк из Himera (без telegram_id): пакетная запись из Himera (writebehind.py)
+-- не создаёт дублей. Пользователи бота под индекс не попадают: владелец может зарегистрировать номер,
+-- для которого уже есть строка из Himera, а несколько пользователей — одну машину.
+-- Дубли среди строк из Himera удаляются здесь же (остаётся самая ранняя), ручная чистка не нужна.
+-- Повторный запуск заменяет глобальный уникальный индекс из прежней версии миграции.
+DROP INDEX IF EXISTS users_car_number_canonical_key;
+CREATE INDEX IF NOT EXISTS users_car_number_canonical_idx ON users (car_number_canonical);
+
+DELETE FROM users AS duplicate
+USING users AS kept
+WHERE duplicate.telegram_id IS NULL
+  AND kept.telegram_id IS NULL
+  AND duplicate.car_number_canonical = kept.car_number_canonical
+  AND duplicate.id > kept.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS users_himera_car_number_canonical_key
+    ON users (car_number_canonical) WHERE telegram_id IS NULL;
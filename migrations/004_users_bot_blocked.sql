@@ -0,0 +1,6 @@
+-- Пользователь заблокировал бота: рассылки (broadcast.py) его пропускают.
+-- Флаг снимается, когда пользователь снова пишет боту /start.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS bot_blocked boolean NOT NULL DEFAULT false;
+
+-- Постраничное чтение получателей рассылки по id
+CREATE INDEX IF NOT EXISTS users_broadcast_recipients_idx ON users (id) WHERE telegram_id IS NOT NULL AND NOT bot_blocked;
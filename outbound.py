@@ -0,0 +1,246 @@
+import asyncio
+import itertools
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+from stats import LatencyStats
+
+# Приоритеты исходящих сообщений: меньше — важнее
+PRIORITY_RELAY = 0 # Пересылка сообщений внутри диалога
+PRIORITY_NOTIFY = 1 # Уведомления бота
+PRIORITY_BULK = 2 # Массовые рассылки
+
+PRIORITY_NAMES = {PRIORITY_RELAY: "relay", PRIORITY_NOTIFY: "notify", PRIORITY_BULK: "bulk"}
+
+# Лимиты Telegram: ~30 сообщений в секунду на бота и ~1 сообщение в секунду в один чат
+OUTBOUND_WORKERS = 4
+OUTBOUND_GLOBAL_RATE = 30.0
+OUTBOUND_CHAT_RATE = 1.0
+OUTBOUND_CHAT_BURST = 3.0
+OUTBOUND_MAX_ATTEMPTS = 3
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        # Сколько ждать до появления токена (с учётом retry_after от Telegram)
+        if self.blocked_until > now:
+            return self.blocked_until - now
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+
+class _Job:
+    __slots__ = ("method", "priority", "future", "enqueued_at", "attempts")
+
+    def __init__(self, method, priority: int, future: asyncio.Future):
+        self.method = method
+        self.priority = priority
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+
+class OutboundQueue:
+    # Очередь исходящих запросов к Bot API с приоритетами, token bucket на бота и на чат
+    # и повтором после TelegramRetryAfter. Работает с любым методом, у которого есть chat_id.
+    def __init__(
+        self,
+        bot: Bot = None,
+        workers: int = OUTBOUND_WORKERS,
+        max_chat_buckets: int = 10000,
+        global_rate: float = OUTBOUND_GLOBAL_RATE,
+        chat_rate: float = OUTBOUND_CHAT_RATE,
+        chat_burst: float = OUTBOUND_CHAT_BURST,
+        max_attempts: int = OUTBOUND_MAX_ATTEMPTS,
+    ):
+        self.bot = bot
+        self.workers = workers
+        self.max_chat_buckets = max_chat_buckets
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_attempts = max_attempts
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.stats = LatencyStats()
+        self.sent = 0
+        self.failures = 0
+        self.retry_after = 0
+        self._chat_buckets = {}
+        self._queue = asyncio.PriorityQueue()
+        self._counter = itertools.count()
+        self._delayed = 0
+        self._active = 0
+        self._tasks = []
+
+    def start(self, bot: Bot = None):
+        # Бот можно передать при старте: он создаётся позже очереди (см. main.create_bot)
+        if bot is not None:
+            self.bot = bot
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() + self._delayed
+
+    def submit(self, method, priority: int = PRIORITY_NOTIFY) -> asyncio.Future:
+        # Отправка без ожидания результата: ошибка только логируется
+        future = self._enqueue(method, priority)
+        future.add_done_callback(_log_failure)
+        return future
+
+    async def send(self, method, priority: int = PRIORITY_NOTIFY):
+        # Ждёт фактической отправки и возвращает результат метода (или пробрасывает ошибку)
+        return await self._enqueue(method, priority)
+
+    async def send_message(self, chat_id: int, text: str, priority: int = PRIORITY_NOTIFY, **kwargs):
+        return await self.send(SendMessage(chat_id=chat_id, text=text, **kwargs), priority)
+
+    def submit_message(self, chat_id: int, text: str, priority: int = PRIORITY_NOTIFY, **kwargs) -> asyncio.Future:
+        return self.submit(SendMessage(chat_id=chat_id, text=text, **kwargs), priority)
+
+    def _enqueue(self, method, priority: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._put(_Job(method, priority, future))
+        return future
+
+    def _put(self, job: _Job):
+        self._queue.put_nowait((job.priority, next(self._counter), job))
+
+    def _put_later(self, job: _Job, delay: float):
+        self._delayed += 1
+
+        def _requeue():
+            self._delayed -= 1
+            self._put(job)
+
+        asyncio.get_running_loop().call_later(delay, _requeue)
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.max_chat_buckets:
+                now = time.monotonic()
+                self._chat_buckets = {key: value for key, value in self._chat_buckets.items() if not value.idle(now)}
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            _, _, job = await self._queue.get()
+            self._active += 1
+            try:
+                await self._process(job)
+            except Exception as e:
+                logging.error("Ошибка обработчика очереди отправки для чата %s: %s", job.method.chat_id, e, extra={"user_id": job.method.chat_id})
+                if not job.future.done():
+                    job.future.set_exception(e)
+            finally:
+                self._active -= 1
+                self._queue.task_done()
+
+    async def _process(self, job: _Job):
+        if job.future.cancelled():
+            return
+        chat_bucket = self._chat_bucket(job.method.chat_id)
+        # Чат упёрся в лимит — откладываем задачу и не держим воркер, остальные чаты идут дальше
+        wait = chat_bucket.delay(time.monotonic())
+        if wait > 0:
+            self._put_later(job, wait)
+            return
+        wait = self.global_bucket.delay(time.monotonic())
+        if wait > 0:
+            await asyncio.sleep(wait)
+        chat_bucket.take()
+        self.global_bucket.take()
+
+        job.attempts += 1
+        try:
+            result = await self.bot(job.method)
+        except TelegramRetryAfter as e:
+            # 429 — это не блокировка бота пользователем: ждём сколько сказал Telegram и повторяем
+            self.retry_after += 1
+            chat_bucket.block(e.retry_after)
+            logging.warning(
+                "Flood limit для чата %s: повтор через %s с (попытка %s).", job.method.chat_id, e.retry_after, job.attempts,
+                extra={"user_id": job.method.chat_id},
+            )
+            if job.attempts < self.max_attempts:
+                self._put_later(job, e.retry_after)
+                return
+            self._finish(job, error=e)
+        except Exception as e:
+            self._finish(job, error=e)
+        else:
+            self._finish(job, result=result)
+
+    def _finish(self, job: _Job, result=None, error: Exception = None):
+        name = PRIORITY_NAMES.get(job.priority, str(job.priority))
+        self.stats.record(name, time.monotonic() - job.enqueued_at, error is not None)
+        if error is not None:
+            self.failures += 1
+        else:
+            self.sent += 1
+        if job.future.done():
+            return
+        if error is not None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
+
+    async def stop(self, timeout: float = 10.0):
+        # Даём очереди дослать накопленное, затем останавливаем воркеры
+        deadline = time.monotonic() + timeout
+        while (self.depth or self._active) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self.depth:
+            logging.warning("Очередь отправки остановлена, не отправлено сообщений: %s", self.depth)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def queue_stats(self):
+        return {
+            "depth": self.depth,
+            "delayed": self._delayed,
+            "active": self._active,
+            "sent": self.sent,
+            "failures": self.failures,
+            "retry_after": self.retry_after,
+            "chats": len(self._chat_buckets),
+        }
+
+
+def _log_failure(future: asyncio.Future):
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error is not None:
+        logging.warning("Не удалось отправить сообщение из очереди: %s", error)
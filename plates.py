@@ -0,0 +1,106 @@
+import re
+
+# Кириллические буквы, совпадающие по начертанию с латинскими (только они допустимы в российских номерах)
+_LOOKALIKES = str.maketrans("АВЕКМНОРСТУХ", "ABEKMHOPCTYX")
+_SEPARATORS = re.compile(r"[^0-9A-ZА-ЯЁ]")
+# Стандартный номер: буква, три цифры, две буквы и код региона (ведущие нули в регионе отбрасываем)
+_STANDARD_PLATE = re.compile(r"^([A-Z]\d{3}[A-Z]{2})0*(\d{2,3})$")
+
+# Поля строки users, которые нужны для поиска собеседника
+INDEX_FIELDS = ("telegram_id", "car_number", "allow_direct", "username")
+
+
+def normalize_plate(text: str) -> str:
+    # Каноническая форма номера: латиница, без пробелов/дефисов, без суффикса RUS
+    plate = _SEPARATORS.sub("", text.upper()).translate(_LOOKALIKES)
+    if plate.endswith("RUS"):
+        plate = plate[:-3]
+    match = _STANDARD_PLATE.match(plate)
+    if match:
+        plate = match.group(1) + match.group(2)
+    return plate
+
+
+def _trigrams(plate: str):
+    padded = f"^{plate}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _edit_distance(a: str, b: str) -> int:
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+
+class PlateIndex:
+    # Индекс номеров в памяти: точный поиск по канонической форме и подсказки
+    # "возможно, вы имели в виду" по общим триграммам с проверкой расстояния Левенштейна
+    def __init__(self):
+        self._records = {}
+        self._by_user = {}
+        self._trigrams = {}
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, plate: str):
+        return plate in self._records
+
+    def get(self, plate: str):
+        record = self._records.get(plate)
+        return dict(record) if record is not None else None
+
+    def add(self, row: dict):
+        plate = normalize_plate(row.get("car_number") or "")
+        if not plate:
+            return
+        record = {field: row.get(field) for field in INDEX_FIELDS}
+        existing = self._records.get(plate)
+        if record["telegram_id"] is None and existing is not None and existing["telegram_id"] is not None:
+            return # Строка из Himera не заменяет пользователя бота с тем же номером
+        self.remove(plate)
+        if record["telegram_id"] is not None:
+            self.remove_user(record["telegram_id"])
+            self._by_user[record["telegram_id"]] = plate
+        self._records[plate] = record
+        for trigram in _trigrams(plate):
+            self._trigrams.setdefault(trigram, set()).add(plate)
+
+    def remove(self, plate: str):
+        record = self._records.pop(plate, None)
+        if record is None:
+            return
+        if record["telegram_id"] is not None and self._by_user.get(record["telegram_id"]) == plate:
+            del self._by_user[record["telegram_id"]]
+        for trigram in _trigrams(plate):
+            plates = self._trigrams.get(trigram)
+            if plates is not None:
+                plates.discard(plate)
+                if not plates:
+                    del self._trigrams[trigram]
+
+    def remove_user(self, telegram_id: int):
+        plate = self._by_user.get(telegram_id)
+        if plate is not None:
+            self.remove(plate)
+
+    def suggest(self, plate: str, limit: int = 3, max_distance: int = 2):
+        counts = {}
+        for trigram in _trigrams(plate):
+            for candidate in self._trigrams.get(trigram, ()):
+                counts[candidate] = counts.get(candidate, 0) + 1
+        # Проверяем расстояние только у кандидатов с наибольшим числом общих триграмм
+        candidates = sorted(counts, key=counts.get, reverse=True)[:limit * 10]
+        scored = []
+        for candidate in candidates:
+            if candidate == plate:
+                continue
+            distance = _edit_distance(plate, candidate)
+            if distance <= max_distance:
+                scored.append((distance, -counts[candidate], candidate))
+        scored.sort()
+        return [candidate for _, _, candidate in scored[:limit]]
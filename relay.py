@@ -0,0 +1,42 @@
+from aiogram.methods import CopyMessage, SendMediaGroup, SendMessage
+from aiogram.types import InputMediaAudio, InputMediaDocument, InputMediaPhoto, InputMediaVideo, Message
+
+# Пересылка сообщений собеседнику без скачивания и повторной загрузки файлов:
+# медиа копируется по file_id (copyMessage), альбом уходит одним sendMediaGroup.
+
+CAPTION_LIMIT = 1024
+# Типы сообщений с подписью: заголовок "от кого" ставим в подпись, а не отдельным сообщением
+CAPTIONED_TYPES = {"photo", "video", "document", "audio", "voice", "animation"}
+_INPUT_MEDIA = {
+    "photo": (InputMediaPhoto, lambda message: message.photo[-1].file_id),
+    "video": (InputMediaVideo, lambda message: message.video.file_id),
+    "document": (InputMediaDocument, lambda message: message.document.file_id),
+    "audio": (InputMediaAudio, lambda message: message.audio.file_id),
+}
+
+
+def relay_methods(message: Message, chat_id: int, header: str, reply_markup=None, album: list = None) -> list:
+    # Методы Bot API, которые доставят сообщение (или альбом) в chat_id, в порядке отправки
+    if album:
+        media = [_input_media(item, header if index == 0 else None) for index, item in enumerate(album)]
+        return [SendMediaGroup(chat_id=chat_id, media=media)]
+    if message.text is not None:
+        return [SendMessage(chat_id=chat_id, text=f"{header}\n\n{message.text.strip()}", reply_markup=reply_markup)]
+    copy = CopyMessage(chat_id=chat_id, from_chat_id=message.chat.id, message_id=message.message_id, reply_markup=reply_markup)
+    if message.content_type in CAPTIONED_TYPES:
+        copy.caption = _caption(header, message.caption)
+        return [copy]
+    # Стикер, геопозиция, контакт и т.п.: подписи нет, заголовок идёт отдельным сообщением
+    return [SendMessage(chat_id=chat_id, text=header), copy]
+
+
+def _caption(header: str, caption: str = None) -> str:
+    # Разметку исходной подписи не переносим: смещения сущностей после заголовка уже не совпадут
+    return (f"{header}\n\n{caption}" if caption else header)[:CAPTION_LIMIT]
+
+
+def _input_media(message: Message, header: str = None):
+    media_class, file_id = _INPUT_MEDIA[message.content_type]
+    if header is not None:
+        return media_class(media=file_id(message), caption=_caption(header, message.caption))
+    return media_class(media=file_id(message), caption=message.caption, caption_entities=message.caption_entities)
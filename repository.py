@@ -0,0 +1,203 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import TYPE_CHECKING
+
+from cache import TTLCache, MISSING
+from plates import INDEX_FIELDS, PlateIndex, normalize_plate
+from stats import LatencyStats
+
+if TYPE_CHECKING:
+    from supabase import Client
+
+# Клиент supabase синхронный: все запросы уходят в отдельный пул потоков,
+# чтобы медленный PostgREST не блокировал event loop.
+# HTTP-соединения переиспользуются внутри клиента (keep-alive), пул потоков ограничивает параллелизм.
+SUPABASE_MAX_WORKERS = 8
+# Кэш профилей пользователей: по telegram_id и по каноническому номеру авто
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 300.0
+# Колонки справочника номеров: только то, что нужно для поиска, плюс ключ постраничного чтения
+DIRECTORY_COLUMNS = ",".join(("id", *INDEX_FIELDS, "updated_at"))
+
+
+class UsersRepository:
+    def __init__(
+        self,
+        client: "Client" = None,
+        max_workers: int = SUPABASE_MAX_WORKERS,
+        table: str = "users",
+        cache_size: int = USER_CACHE_SIZE,
+        cache_ttl: float = USER_CACHE_TTL,
+    ):
+        self.client = client
+        self._owns_client = False
+        self.table_name = table
+        self.stats = LatencyStats()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="supabase")
+        self.by_telegram_id = TTLCache(cache_size, cache_ttl)
+        self.by_car_number = TTLCache(cache_size, cache_ttl)
+        # Найденные номера: точный поиск и подсказки без обращения к Supabase
+        self.plates = PlateIndex()
+        # Увеличивается при каждой записи: чтение, начатое до записи, не должно положить в кэш устаревшие данные
+        self._generation = 0
+
+    def connect(self, url: str, key: str):
+        # Клиент создаётся при старте бота, если его не передали заранее (например, заглушку в бенчмарке).
+        # Импорт supabase тяжёлый, поэтому он тоже откладывается до старта
+        if self.client is None:
+            from supabase import create_client
+
+            self.client = create_client(url, key)
+            self._owns_client = True
+
+    async def _run(self, operation: str, build_query):
+        loop = asyncio.get_running_loop()
+        with self.stats.measure(operation):
+            return await loop.run_in_executor(self._executor, partial(_execute, self.client, self.table_name, build_query))
+
+    async def get_by_telegram_id(self, telegram_id: int):
+        cached = self.by_telegram_id.get(telegram_id)
+        if cached is not MISSING:
+            return cached
+        generation = self._generation
+        response = await self._run("get_by_telegram_id", lambda t: t.select("*").eq("telegram_id", telegram_id).limit(1))
+        row = response.data[0] if response.data else None
+        if generation == self._generation:
+            self.by_telegram_id.set(telegram_id, row)
+        return row
+
+    async def get_by_car_number(self, car_number: str):
+        plate = normalize_plate(car_number)
+        indexed = self.plates.get(plate)
+        if indexed is not None:
+            return indexed
+        cached = self.by_car_number.get(plate)
+        if cached is not MISSING:
+            return cached
+        generation = self._generation
+        # Номер может быть и у пользователя бота, и у строки из Himera: пользователь бота (telegram_id не NULL) первым
+        response = await self._run(
+            "get_by_car_number",
+            lambda t: t.select("*").eq("car_number_canonical", plate).order("telegram_id", nullsfirst=False).limit(1),
+        )
+        row = response.data[0] if response.data else None
+        if generation == self._generation:
+            self.by_car_number.set(plate, row)
+            if row is not None:
+                self.plates.add(row)
+        return row
+
+    async def fetch_directory_page(self, after=None, limit: int = 1000):
+        # Страница справочника в порядке (updated_at, id), начиная строго после ключа after.
+        # Один и тот же запрос служит и для полной загрузки (after=None), и для догрузки изменений:
+        # догрузка начинается с (watermark - lag, 0), то есть со всех строк с updated_at >= watermark - lag
+        # (см. PlateDirectorySync.sync)
+        def build_query(table):
+            query = table.select(DIRECTORY_COLUMNS).order("updated_at,id").limit(limit)
+            if after is not None:
+                updated_at, row_id = after
+                query = query.or_(f'updated_at.gt."{updated_at}",and(updated_at.eq."{updated_at}",id.gt.{row_id})')
+            return query
+        response = await self._run("fetch_directory_page", build_query)
+        return response.data
+
+    async def fetch_recipients(self, after_id: int = 0, limit: int = 500):
+        # Страница получателей рассылки по id: пользователи бота, которые не заблокировали его
+        def build_query(table):
+            return (
+                table.select("id,telegram_id")
+                .gt("id", after_id)
+                .not_.is_("telegram_id", "null")
+                .eq("bot_blocked", False)
+                .order("id")
+                .limit(limit)
+            )
+        response = await self._run("fetch_recipients", build_query)
+        return response.data
+
+    async def mark_blocked(self, telegram_ids: list, blocked: bool = True):
+        # Пользователь заблокировал бота (403 при отправке) или снова написал ему
+        try:
+            response = await self._run("mark_blocked", lambda t: t.update({"bot_blocked": blocked}).in_("telegram_id", telegram_ids))
+        finally:
+            for telegram_id in telegram_ids:
+                self._invalidate(telegram_id)
+        return response.data
+
+    def suggest_car_numbers(self, car_number: str, limit: int = 3):
+        return self.plates.suggest(normalize_plate(car_number), limit)
+
+    async def insert(self, row: dict):
+        row = _with_canonical_plate(row)
+        try:
+            response = await self._run("insert", lambda t: t.insert(row))
+        finally:
+            self._invalidate(row.get("telegram_id"), row.get("car_number"))
+        return response.data[0] if response.data else None
+
+    async def upsert_many(self, rows: list):
+        # Пакетная вставка строк из Himera для номеров, которых ещё нет в users. Уже существующие строки не трогаем:
+        # зарегистрированный в боте владелец важнее данных из Himera. Уникальный индекс есть только у строк
+        # без telegram_id (migrations/003), поэтому ON CONFLICT не подходит: существующие номера читаются
+        # отдельным запросом. Если строку с тем же номером успел вставить другой процесс, вставка пачки
+        # упадёт на индексе, и при повторе (см. UpsertBatcher) этот номер отсеется
+        rows = [_with_canonical_plate(row) for row in rows]
+        plates = [row["car_number_canonical"] for row in rows]
+        try:
+            response = await self._run(
+                "upsert_many_existing",
+                lambda t: t.select("car_number_canonical").in_("car_number_canonical", plates),
+            )
+            existing = {row["car_number_canonical"] for row in response.data}
+            rows = [row for row in rows if row["car_number_canonical"] not in existing]
+            if not rows:
+                return []
+            response = await self._run("upsert_many", lambda t: t.insert(rows))
+        finally:
+            self._invalidate(None, *plates)
+        return response.data
+
+    async def update(self, telegram_id: int, fields: dict):
+        cached = self.by_telegram_id.peek(telegram_id)
+        old_car_number = cached.get("car_number") if cached else None
+        fields = _with_canonical_plate(fields)
+        try:
+            response = await self._run("update", lambda t: t.update(fields).eq("telegram_id", telegram_id))
+        finally:
+            self._invalidate(telegram_id, old_car_number, fields.get("car_number"))
+        return response.data
+
+    def _invalidate(self, telegram_id, *car_numbers):
+        self._generation += 1
+        if telegram_id is not None:
+            self.by_telegram_id.invalidate(telegram_id)
+            self.plates.remove_user(telegram_id)
+        for car_number in car_numbers:
+            if car_number:
+                plate = normalize_plate(car_number)
+                self.by_car_number.invalidate(plate)
+                self.plates.remove(plate)
+
+    def cache_stats(self):
+        return {"telegram_id": self.by_telegram_id.stats(), "car_number": self.by_car_number.stats()}
+
+    def close(self):
+        logging.info("Закрываем пул потоков Supabase. Статистика запросов: %s", self.stats.snapshot())
+        self._executor.shutdown(wait=True)
+        if self._owns_client:
+            # Закрывает HTTP-соединения PostgREST (клиент синхронный, несмотря на имя метода)
+            self.client.postgrest.aclose()
+            self.client, self._owns_client = None, False
+
+
+def _with_canonical_plate(fields: dict) -> dict:
+    # Колонка car_number_canonical (см. migrations/001_users_car_number_canonical.sql) всегда пишется вместе с car_number
+    if fields.get("car_number"):
+        return {**fields, "car_number_canonical": normalize_plate(fields["car_number"])}
+    return fields
+
+
+def _execute(client: "Client", table: str, build_query):
+    return build_query(client.table(table)).execute()
@@ -0,0 +1,98 @@
+import logging
+import time
+from collections import deque
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    # После failure_threshold ошибок подряд цепь размыкается на reset_timeout секунд,
+    # затем пропускается half_open_max_calls пробных запросов
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0, half_open_max_calls: int = 1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.failures = 0
+        self.transitions = {self.CLOSED: 0, self.OPEN: 0, self.HALF_OPEN: 0}
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._transition(self.HALF_OPEN)
+        return self._state
+
+    def allow_request(self) -> bool:
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and self._probes < self.half_open_max_calls:
+            self._probes += 1
+            return True
+        return False
+
+    def can_request(self) -> bool:
+        # То же, что allow_request, но пробный запрос не расходует: для проверки заранее
+        state = self.state
+        return state == self.CLOSED or (state == self.HALF_OPEN and self._probes < self.half_open_max_calls)
+
+    def record_success(self):
+        self.failures = 0
+        if self._state != self.CLOSED:
+            self._transition(self.CLOSED)
+
+    def record_failure(self):
+        self.failures += 1
+        if self._state == self.HALF_OPEN or (self._state == self.CLOSED and self.failures >= self.failure_threshold):
+            self._opened_at = time.monotonic()
+            self._transition(self.OPEN)
+
+    def _transition(self, state: str):
+        logging.warning("Circuit breaker %s: %s -> %s (ошибок подряд: %s)", self.name, self._state, state, self.failures)
+        self._state = state
+        self._probes = 0
+        self.transitions[state] += 1
+
+    def stats(self):
+        return {"state": self.state, "failures": self.failures, "transitions": dict(self.transitions)}
+
+
+class RetryBudget:
+    # Повторы разрешены, пока их число за окно не превышает ratio от числа запросов
+    # плюс небольшой фиксированный запас, чтобы редкие запросы тоже могли повторяться
+    def __init__(self, ratio: float = 0.2, min_retries_per_second: float = 0.5, window: float = 10.0):
+        self.ratio = ratio
+        self.min_retries_per_second = min_retries_per_second
+        self.window = window
+        self.exhausted = 0
+        self._requests = deque()
+        self._retries = deque()
+
+    def _prune(self, now: float):
+        for events in (self._requests, self._retries):
+            while events and now - events[0] > self.window:
+                events.popleft()
+
+    def record_request(self):
+        now = time.monotonic()
+        self._prune(now)
+        self._requests.append(now)
+
+    def try_spend(self) -> bool:
+        now = time.monotonic()
+        self._prune(now)
+        allowed = self.ratio * len(self._requests) + self.min_retries_per_second * self.window
+        if len(self._retries) >= allowed:
+            self.exhausted += 1
+            return False
+        self._retries.append(now)
+        return True
+
+    def stats(self):
+        self._prune(time.monotonic())
+        return {"requests": len(self._requests), "retries": len(self._retries), "exhausted": self.exhausted}
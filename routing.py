@@ -0,0 +1,38 @@
+from typing import Awaitable, Callable, NamedTuple
+
+# Обработчик шага: (message, state, text) -> None
+StepHandler = Callable[..., Awaitable[None]]
+
+
+class Route(NamedTuple):
+    name: str
+    handler: StepHandler
+
+
+class MessageRouter:
+    # Таблица диспетчеризации текстовых сообщений: сначала точное совпадение с кнопкой меню,
+    # затем обработчик текущего шага пользователя. Оба поиска — обращение к словарю.
+    def __init__(self):
+        self.buttons = {}
+        self.steps = {}
+        self.default_route = None
+
+    def button(self, text: str):
+        def register(handler: StepHandler):
+            self.buttons[text] = Route(handler.__name__, handler)
+            return handler
+        return register
+
+    def step(self, *steps: str):
+        def register(handler: StepHandler):
+            for step in steps:
+                self.steps[step] = Route(handler.__name__, handler)
+            return handler
+        return register
+
+    def default(self, handler: StepHandler):
+        self.default_route = Route(handler.__name__, handler)
+        return handler
+
+    def resolve(self, text: str, step: str) -> Route:
+        return self.buttons.get(text) or self.steps.get(step) or self.default_route
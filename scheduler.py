@@ -0,0 +1,107 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+
+class DeadlineScheduler:
+    # Таймеры на min-куче: фоновая задача спит ровно до ближайшего дедлайна.
+    # Каждый таймер имеет ключ (например, ("shutdown", user_id)); повторное планирование
+    # по тому же ключу заменяет старый таймер. Отмена помечает запись, а из кучи она
+    # удаляется при извлечении, поэтому schedule/cancel стоят O(log n).
+    def __init__(self, name: str = "scheduler"):
+        self.name = name
+        self.fired = 0
+        self.cancelled = 0
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._running = set()
+
+    def schedule(self, key, deadline: float, callback, *args):
+        # deadline — время по time.time(), чтобы его можно было хранить между перезапусками
+        self.cancel(key, count=False)
+        entry = [deadline, next(self._counter), key, callback, args, False]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+        if self._heap[0] is entry:
+            self._wakeup.set()
+
+    def cancel(self, key, count: bool = True) -> bool:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        entry[5] = True
+        if count:
+            self.cancelled += 1
+        # Не даём куче разрастаться отменёнными записями
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._entries):
+            self._heap = [item for item in self._heap if not item[5]]
+            heapq.heapify(self._heap)
+        return True
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def next_deadline(self):
+        while self._heap and self._heap[0][5]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._running:
+            await asyncio.gather(*self._running, return_exceptions=True)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            deadline = self.next_deadline()
+            if deadline is None:
+                await self._wakeup.wait()
+                continue
+            delay = deadline - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, _, key, callback, args, _ = heapq.heappop(self._heap)
+            del self._entries[key]
+            self.fired += 1
+            # Колбэки выполняются параллельно и не задерживают следующие таймеры
+            task = asyncio.create_task(self._fire(key, callback, args))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _fire(self, key, callback, args):
+        try:
+            await callback(*args)
+        except Exception as e:
+            logging.error("Ошибка в таймере %s %s: %s", self.name, key, e)
+
+    def stats(self):
+        next_deadline = self.next_deadline()
+        return {
+            "pending": len(self._entries),
+            "fired": self.fired,
+            "cancelled": self.cancelled,
+            "next_in": max(0.0, next_deadline - time.time()) if next_deadline is not None else None,
+        }
@@ -0,0 +1,158 @@
+import uuid
+from collections import Counter
+from datetime import datetime
+
+from storage import StateStorage
+
+# Пространства имён в хранилище
+USER_STATES = "user_state"
+PENDING_SHUTDOWNS = "pending_shutdown"
+SHUTDOWN_TARGETS = "shutdown_target"
+
+IDLE = {"step": "idle"}
+
+# Через сколько секунд без активности сессия сбрасывается (см. SessionStore.session_ttl)
+SESSION_IDLE_TTL = 1800.0 # Поиск, обращение в поддержку
+DIALOG_START_TTL = 600.0 # Диалог начат, первого сообщения нет
+DIALOG_IDLE_TTL = 86400.0 # Диалог, в котором давно не писали
+DIALOG_STEPS = ("awaiting_first_message", "dialog")
+
+
+class SessionStore:
+    # Состояния пользователей и реестр диалогов поверх StateStorage.
+    # user_state: {user_id: {"step": "...", "target_id": ..., "dialog_id": ..., "sender_car_number": ..., "target_car_number": ...}}
+    # pending_shutdown: {initiator_user_id: {"target_id": ..., "dialog_id": ..., "shutdown_time": datetime_object}}
+    # shutdown_target: {target_user_id: {"initiator_id": ..., "dialog_id": ...}} — обратный индекс запросов на завершение
+    # Все изменения, затрагивающие обоих участников диалога, пишутся одной атомарной операцией.
+    def __init__(
+        self,
+        storage: StateStorage,
+        idle_ttl: float = SESSION_IDLE_TTL,
+        dialog_start_ttl: float = DIALOG_START_TTL,
+        dialog_idle_ttl: float = DIALOG_IDLE_TTL,
+    ):
+        self.storage = storage
+        self.idle_ttl = idle_ttl
+        self.dialog_start_ttl = dialog_start_ttl
+        self.dialog_idle_ttl = dialog_idle_ttl
+
+    async def get_state(self, user_id: int) -> dict:
+        return await self.storage.get(USER_STATES, user_id) or dict(IDLE)
+
+    async def find_state(self, user_id: int):
+        return await self.storage.get(USER_STATES, user_id)
+
+    async def set_state(self, user_id: int, state: dict):
+        await self.storage.set(USER_STATES, user_id, _stored(state))
+
+    async def delete_state(self, user_id: int):
+        await self.storage.delete(USER_STATES, user_id)
+
+    async def commit(self, states: dict):
+        # Атомарно записывает состояния нескольких пользователей; None вместо состояния удаляет запись
+        await self.storage.apply({(USER_STATES, user_id): _stored(state) for user_id, state in states.items()})
+
+    async def set_steps(self, steps: dict, changes: dict = None):
+        # Меняет только step у существующих состояний, остальные поля сохраняются.
+        # Состояния читаются до apply(), вне MULTI/EXEC: от параллельной записи тех же пользователей защищают
+        # замки вызывающего кода (App.user_locks), а они действуют в пределах одного процесса.
+        # Несколько процессов бота на общем хранилище могут потерять изменение, сделанное между чтением и записью
+        changes = dict(changes or {})
+        for user_id, step in steps.items():
+            state = await self.find_state(user_id)
+            if state is not None:
+                changes[(USER_STATES, user_id)] = _stored({**state, "step": step})
+        if changes:
+            await self.storage.apply(changes)
+
+    # --- Диалоги ---
+    async def start_dialog(self, initiator_id: int, target_id: int, sender_car_number: str, target_car_number: str) -> str:
+        dialog_id = uuid.uuid4().hex
+        await self.commit({
+            initiator_id: {
+                "step": "awaiting_first_message", # Инициатор ждет подтверждения
+                "target_id": target_id,
+                "dialog_id": dialog_id,
+                "sender_car_number": sender_car_number,
+                "target_car_number": target_car_number
+            },
+            target_id: {
+                "step": "dialog", # Цель сразу в состоянии диалога, как только примет первое сообщение
+                "target_id": initiator_id,
+                "dialog_id": dialog_id,
+                "sender_car_number": target_car_number, # Для цели отправитель - это car_number инициатора
+                "target_car_number": sender_car_number # Для цели цель - это ее собственный car_number
+            },
+        })
+        return dialog_id
+
+    async def end_dialog(self, *user_ids: int):
+        await self.commit({user_id: None for user_id in user_ids})
+
+    # --- Запросы на завершение диалога ---
+    async def request_shutdown(self, initiator_id: int, initiator_state: dict, target_id: int, target_state: dict, shutdown_time: datetime):
+        dialog_id = initiator_state.get("dialog_id")
+        await self.storage.apply({
+            (USER_STATES, initiator_id): {**initiator_state, "step": "awaiting_shutdown_confirmation"},
+            (USER_STATES, target_id): {**target_state, "step": "shutdown_requested"},
+            (PENDING_SHUTDOWNS, initiator_id): {"target_id": target_id, "dialog_id": dialog_id, "shutdown_time": shutdown_time.timestamp()},
+            (SHUTDOWN_TARGETS, target_id): {"initiator_id": initiator_id, "dialog_id": dialog_id},
+        })
+
+    async def resolve_shutdown(self, initiator_id: int, target_id: int, step: str):
+        # step="dialog" — диалог продолжается (отказ, таймаут, ошибка), step="idle" — диалог завершён.
+        # Для step="dialog" состояния читаются вне транзакции (см. set_steps)
+        changes = {
+            (PENDING_SHUTDOWNS, initiator_id): None,
+            (SHUTDOWN_TARGETS, target_id): None,
+        }
+        if step == "idle":
+            changes[(USER_STATES, initiator_id)] = None
+            changes[(USER_STATES, target_id)] = None
+            await self.storage.apply(changes)
+        else:
+            await self.set_steps({initiator_id: step, target_id: step}, changes)
+
+    async def get_shutdown(self, initiator_id: int):
+        data = await self.storage.get(PENDING_SHUTDOWNS, initiator_id)
+        return _decode_shutdown(data) if data is not None else None
+
+    async def find_shutdown_initiator(self, target_id: int):
+        data = await self.storage.get(SHUTDOWN_TARGETS, target_id)
+        return data["initiator_id"] if data else None
+
+    async def pending_shutdowns(self) -> dict:
+        return {int(key): _decode_shutdown(data) for key, data in await self.storage.items(PENDING_SHUTDOWNS)}
+
+    # --- Живые сессии ---
+    async def states(self) -> dict:
+        return {int(key): state for key, state in await self.storage.items(USER_STATES)}
+
+    async def report(self) -> dict:
+        steps = Counter(state.get("step") for state in (await self.states()).values())
+        return {
+            "total": sum(steps.values()),
+            "steps": dict(steps.most_common()),
+            "bytes": self.storage.footprint(USER_STATES),
+        }
+
+    def session_ttl(self, state: dict):
+        # None — сессия не сбрасывается по неактивности: регистрация (иначе пользователь останется без номера авто)
+        # и завершение диалога (у него свой таймаут подтверждения)
+        step = state.get("step")
+        if step == "awaiting_first_message":
+            return self.dialog_start_ttl
+        if step == "dialog":
+            return self.dialog_idle_ttl
+        if step in ("search_car", "support_message"):
+            return self.idle_ttl
+        return None
+
+
+def _stored(state):
+    # Состояние по умолчанию не храним: get_state() и так вернёт idle, а память не растёт с числом пользователей
+    return None if state is None or state == IDLE else state
+
+
+def _decode_shutdown(data: dict) -> dict:
+    return {**data, "shutdown_time": datetime.fromtimestamp(data["shutdown_time"])}
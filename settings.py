@@ -0,0 +1,100 @@
+import os
+from dataclasses import dataclass, fields
+
+from dotenv import load_dotenv
+
+import broadcast
+import directory
+import himera
+import logs
+import metrics
+import outbound
+import repository
+import sessions
+import support
+import throttle
+import writebehind
+
+REQUIRED = ("bot_token", "supabase_url", "supabase_key", "himera_api_key")
+
+
+@dataclass(frozen=True, slots=True)
+class Settings:
+    # Настройки приложения из окружения: имя переменной — имя поля в верхнем регистре.
+    # Чтение ничего не проверяет и не создаёт, обязательные значения проверяет validate() при запуске
+    bot_token: str = ""
+    supabase_url: str = ""
+    supabase_key: str = ""
+    himera_api_key: str = ""
+    admin_id: int = 0 # Убедитесь, что ADMIN_ID установлен в .env
+    # memory:// (по умолчанию), sqlite:///state.db или redis://host:6379/0
+    state_storage_url: str = "memory://"
+    # Режим получения обновлений: polling (по умолчанию) или webhook
+    run_mode: str = "polling"
+    webhook_url: str = "" # Публичный адрес, например https://bot.example.com
+    webhook_path: str = "/webhook"
+    webhook_secret: str = ""
+    webapp_host: str = "0.0.0.0"
+    webapp_port: int = 8080
+    media_group_wait: float = 0.6 # Сколько ждать остальные части альбома, с
+    shutdown_drain_timeout: float = 15.0 # Сколько ждать завершения обработчиков при остановке, с
+
+    # Параметры компонентов. Значения по умолчанию и их смысл — в модулях компонентов
+    log_level: str = logs.LOG_LEVEL
+    log_format: str = logs.LOG_FORMAT
+    log_message_sample_rate: float = logs.LOG_MESSAGE_SAMPLE_RATE
+    metrics_host: str = metrics.METRICS_HOST
+    metrics_port: int = metrics.METRICS_PORT
+    supabase_max_workers: int = repository.SUPABASE_MAX_WORKERS
+    user_cache_size: int = repository.USER_CACHE_SIZE
+    user_cache_ttl: float = repository.USER_CACHE_TTL
+    plate_sync_interval: float = directory.PLATE_SYNC_INTERVAL
+    plate_sync_page_size: int = directory.PLATE_SYNC_PAGE_SIZE
+    plate_sync_lag: float = directory.PLATE_SYNC_LAG
+    himera_base_url: str = himera.HIMERA_BASE_URL
+    himera_timeout: float = himera.HIMERA_TIMEOUT
+    himera_max_connections: int = himera.HIMERA_MAX_CONNECTIONS
+    himera_cache_size: int = himera.HIMERA_CACHE_SIZE
+    himera_cache_ttl: float = himera.HIMERA_CACHE_TTL
+    himera_negative_cache_ttl: float = himera.HIMERA_NEGATIVE_CACHE_TTL
+    himera_max_concurrency: int = himera.HIMERA_MAX_CONCURRENCY
+    himera_queue_timeout: float = himera.HIMERA_QUEUE_TIMEOUT
+    himera_max_retries: int = himera.HIMERA_MAX_RETRIES
+    himera_retry_base_delay: float = himera.HIMERA_RETRY_BASE_DELAY
+    himera_breaker_threshold: int = himera.HIMERA_BREAKER_THRESHOLD
+    himera_breaker_reset_timeout: float = himera.HIMERA_BREAKER_RESET_TIMEOUT
+    himera_write_interval: float = writebehind.HIMERA_WRITE_INTERVAL
+    himera_write_batch_size: int = writebehind.HIMERA_WRITE_BATCH_SIZE
+    himera_write_max_attempts: int = writebehind.HIMERA_WRITE_MAX_ATTEMPTS
+    outbound_workers: int = outbound.OUTBOUND_WORKERS
+    outbound_global_rate: float = outbound.OUTBOUND_GLOBAL_RATE
+    outbound_chat_rate: float = outbound.OUTBOUND_CHAT_RATE
+    outbound_chat_burst: float = outbound.OUTBOUND_CHAT_BURST
+    outbound_max_attempts: int = outbound.OUTBOUND_MAX_ATTEMPTS
+    session_idle_ttl: float = sessions.SESSION_IDLE_TTL
+    dialog_start_ttl: float = sessions.DIALOG_START_TTL
+    dialog_idle_ttl: float = sessions.DIALOG_IDLE_TTL
+    support_ticket_ttl: float = support.SUPPORT_TICKET_TTL
+    broadcast_page_size: int = broadcast.BROADCAST_PAGE_SIZE
+    throttle_search: str = throttle.THROTTLE_SEARCH # "10/60" — 10 действий за 60 секунд
+    throttle_himera: str = throttle.THROTTLE_HIMERA
+    throttle_dialog_start: str = throttle.THROTTLE_DIALOG_START
+
+    @classmethod
+    def from_env(cls, environ=None) -> "Settings":
+        # Без аргумента читает окружение процесса вместе с .env. Модули бота окружение не читают:
+        # все параметры приходят отсюда через конструкторы, поэтому порядок импорта не важен
+        if environ is None:
+            load_dotenv()
+            environ = os.environ
+        values = {}
+        for field in fields(cls):
+            raw = environ.get(field.name.upper())
+            if raw is not None and raw != "":
+                values[field.name] = field.type(raw) if field.type in (int, float) else raw
+        return cls(**values)
+
+    def validate(self):
+        missing = [name.upper() for name in REQUIRED if not getattr(self, name)]
+        if missing:
+            raise ValueError(f"❌ Не заданы обязательные переменные окружения: {', '.join(missing)}")
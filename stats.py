@@ -0,0 +1,90 @@
+import time
+from bisect import bisect_left
+from collections import deque
+from itertools import accumulate
+from contextlib import contextmanager
+
+# Границы корзин гистограммы задержек, в секундах (как в клиентах Prometheus)
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class LatencyStats:
+    # Счётчики задержек по операциям: количество, ошибки, сумма/максимум, окно последних замеров для перцентилей
+    # и накопительная гистограмма для /metrics
+    def __init__(self, window: int = 1000, buckets: tuple = HISTOGRAM_BUCKETS):
+        self.window = window
+        self.buckets = buckets
+        self._ops = {}
+
+    def _op(self, name: str):
+        op = self._ops.get(name)
+        if op is None:
+            op = self._ops[name] = {
+                "count": 0,
+                "errors": 0,
+                "total": 0.0,
+                "max": 0.0,
+                "recent": deque(maxlen=self.window),
+                "buckets": [0] * (len(self.buckets) + 1),
+            }
+        return op
+
+    def record(self, name: str, elapsed: float, error: bool = False):
+        op = self._op(name)
+        op["count"] += 1
+        op["total"] += elapsed
+        if elapsed > op["max"]:
+            op["max"] = elapsed
+        if error:
+            op["errors"] += 1
+        op["recent"].append(elapsed)
+        op["buckets"][bisect_left(self.buckets, elapsed)] += 1
+
+    @contextmanager
+    def measure(self, name: str):
+        started = time.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.record(name, time.perf_counter() - started, error)
+
+    def snapshot(self):
+        result = {}
+        for name, op in self._ops.items():
+            recent = sorted(op["recent"])
+            result[name] = {
+                "count": op["count"],
+                "errors": op["errors"],
+                "avg_ms": op["total"] / op["count"] * 1000 if op["count"] else 0.0,
+                "max_ms": op["max"] * 1000,
+                "p50_ms": _percentile(recent, 0.50) * 1000,
+                "p99_ms": _percentile(recent, 0.99) * 1000,
+            }
+        return result
+
+    def histograms(self):
+        # {name: {"buckets": [(le, накопленное количество), ...], "count": ..., "sum": ..., "errors": ...}}
+        result = {}
+        for name, op in self._ops.items():
+            cumulative = list(accumulate(op["buckets"]))
+            result[name] = {
+                "buckets": list(zip(self.buckets, cumulative)) + [(float("inf"), cumulative[-1])],
+                "count": op["count"],
+                "sum": op["total"],
+                "errors": op["errors"],
+            }
+        return result
+
+    def reset(self):
+        self._ops.clear()
+
+
+def _percentile(sorted_values, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
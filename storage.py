@@ -0,0 +1,315 @@
+import asyncio
+import json
+import sqlite3
+import sys
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, unquote
+
+# Хранилище состояний: пространства имён (namespace) с JSON-словарями по ключу.
+# apply() записывает несколько изменений атомарно — так оба участника диалога
+# всегда обновляются вместе. value=None в apply() означает удаление ключа.
+
+
+class StateStorage(ABC):
+    @abstractmethod
+    async def get(self, namespace: str, key):
+        ...
+
+    @abstractmethod
+    async def apply(self, changes: dict):
+        # changes: {(namespace, key): dict | None}
+        ...
+
+    @abstractmethod
+    async def items(self, namespace: str):
+        ...
+
+    async def count(self, namespace: str) -> int:
+        return len(await self.items(namespace))
+
+    def footprint(self, namespace: str):
+        # Примерный объём памяти процесса под namespace в байтах; None — данные хранятся вне процесса
+        return None
+
+    async def set(self, namespace: str, key, value: dict):
+        await self.apply({(namespace, key): value})
+
+    async def delete(self, namespace: str, key):
+        await self.apply({(namespace, key): None})
+
+    async def close(self):
+        pass
+
+
+@dataclass(slots=True)
+class _Record:
+    # Компактная запись вместо словаря: кортеж имён полей общий для всех записей одной формы
+    fields: tuple
+    values: tuple
+
+    def to_dict(self) -> dict:
+        return dict(zip(self.fields, self.values))
+
+
+class MemoryStorage(StateStorage):
+    def __init__(self):
+        self._data = {}
+        self._shapes = {}
+
+    def _record(self, value: dict) -> _Record:
+        fields = tuple(value)
+        fields = self._shapes.setdefault(fields, fields)
+        return _Record(fields, tuple(value.values()))
+
+    async def get(self, namespace: str, key):
+        record = self._data.get(namespace, {}).get(str(key))
+        return record.to_dict() if record is not None else None
+
+    async def apply(self, changes: dict):
+        for (namespace, key), value in changes.items():
+            bucket = self._data.setdefault(namespace, {})
+            if value is None:
+                bucket.pop(str(key), None)
+            else:
+                bucket[str(key)] = self._record(value)
+
+    async def items(self, namespace: str):
+        return [(key, record.to_dict()) for key, record in self._data.get(namespace, {}).items()]
+
+    async def count(self, namespace: str) -> int:
+        return len(self._data.get(namespace, {}))
+
+    def footprint(self, namespace: str):
+        bucket = self._data.get(namespace, {})
+        total = sys.getsizeof(bucket)
+        for key, record in bucket.items():
+            total += sys.getsizeof(key) + sys.getsizeof(record) + sys.getsizeof(record.values)
+            total += sum(sys.getsizeof(value) for value in record.values if value is not None)
+        return total
+
+
+class SQLiteStorage(StateStorage):
+    # Соединение sqlite привязано к одному потоку, поэтому все запросы идут через однопоточный executor
+    def __init__(self, path: str):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-state")
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS state ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+            self._conn.commit()
+        return self._conn
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _get(self, namespace, key):
+        row = self._connect().execute("SELECT value FROM state WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _apply(self, changes):
+        conn = self._connect()
+        with conn:
+            for (namespace, key), value in changes.items():
+                if value is None:
+                    conn.execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, str(key)))
+                else:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO state (namespace, key, value) VALUES (?, ?, ?)",
+                        (namespace, str(key), json.dumps(value, ensure_ascii=False)),
+                    )
+
+    def _items(self, namespace):
+        rows = self._connect().execute("SELECT key, value FROM state WHERE namespace = ?", (namespace,)).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def _count(self, namespace):
+        return self._connect().execute("SELECT COUNT(*) FROM state WHERE namespace = ?", (namespace,)).fetchone()[0]
+
+    async def get(self, namespace: str, key):
+        return await self._run(self._get, namespace, str(key))
+
+    async def apply(self, changes: dict):
+        await self._run(self._apply, changes)
+
+    async def items(self, namespace: str):
+        return await self._run(self._items, namespace)
+
+    async def count(self, namespace: str) -> int:
+        return await self._run(self._count, namespace)
+
+    async def close(self):
+        def _close():
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        await self._run(_close)
+        self._executor.shutdown(wait=True)
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisStorage(StateStorage):
+    # Минимальный клиент протокола RESP поверх asyncio: работает с Redis, KeyDB, Dragonfly
+    # и с любым локальным сервером, говорящим на RESP. Каждый ключ хранится отдельной строкой
+    # "<prefix>:<namespace>:<key>", так что данные шардируются по ключам; apply() идёт через MULTI/EXEC.
+    def __init__(self, host: str = "localhost", port: int = 6379, db: int = 0, password: str = None, prefix: str = "carbot"):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.prefix = prefix
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    def _key(self, namespace: str, key) -> str:
+        return f"{self.prefix}:{namespace}:{key}"
+
+    async def _ensure_connection(self):
+        if self._writer is not None and not self._writer.is_closing():
+            return
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        # Неверный пароль или номер базы — ошибка сразу, а не запись состояний в базу 0
+        if self.password:
+            _raise_errors(await self._roundtrip([("AUTH", self.password)]))
+        if self.db:
+            _raise_errors(await self._roundtrip([("SELECT", str(self.db))]))
+
+    async def _roundtrip(self, commands):
+        self._writer.write(b"".join(_encode_command(command) for command in commands))
+        await self._writer.drain()
+        return [await _read_reply(self._reader) for _ in commands]
+
+    async def _execute(self, *commands):
+        async with self._lock:
+            try:
+                await self._ensure_connection()
+                replies = await self._roundtrip(commands)
+            except BaseException:
+                # Обрыв, ошибка разбора или отмена посреди обмена: в сокете могут остаться непрочитанные
+                # ответы, и следующая команда прочитала бы чужой. Такое соединение не переиспользуем
+                if self._writer is not None:
+                    self._writer.close()
+                    self._writer = None
+                raise
+        _raise_errors(replies)
+        return replies
+
+    async def get(self, namespace: str, key):
+        (value,) = await self._execute(("GET", self._key(namespace, key)))
+        return json.loads(value) if value is not None else None
+
+    async def apply(self, changes: dict):
+        commands = [("MULTI",)]
+        for (namespace, key), value in changes.items():
+            if value is None:
+                commands.append(("DEL", self._key(namespace, key)))
+            else:
+                commands.append(("SET", self._key(namespace, key), json.dumps(value, ensure_ascii=False)))
+        commands.append(("EXEC",))
+        *_, results = await self._execute(*commands)
+        # Ошибка команды внутри MULTI не отменяет остальные: EXEC возвращает её в массиве результатов
+        _raise_errors(results or [])
+
+    async def _scan(self, namespace: str):
+        keys = []
+        cursor = "0"
+        while True:
+            ((cursor, batch),) = await self._execute(("SCAN", cursor, "MATCH", self._key(namespace, "*"), "COUNT", "500"))
+            keys.extend(batch)
+            if cursor == "0":
+                return keys
+
+    async def items(self, namespace: str):
+        prefix = self._key(namespace, "")
+        keys = await self._scan(namespace)
+        if not keys:
+            return []
+        (values,) = await self._execute(("MGET", *keys))
+        return [
+            (key[len(prefix):], json.loads(value))
+            for key, value in zip(keys, values)
+            if value is not None
+        ]
+
+    async def count(self, namespace: str) -> int:
+        # Только ключи, без чтения значений
+        return len(await self._scan(namespace))
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except ConnectionError:
+                pass
+            self._writer = None
+
+
+def _raise_errors(replies: list):
+    for reply in replies:
+        if isinstance(reply, RedisError):
+            raise reply
+
+
+def _encode_command(args) -> bytes:
+    parts = [f"*{len(args)}\r\n".encode()]
+    for arg in args:
+        data = arg.encode() if isinstance(arg, str) else bytes(arg)
+        parts.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+    return b"".join(parts)
+
+
+async def _read_reply(reader: asyncio.StreamReader):
+    line = await reader.readuntil(b"\r\n")
+    kind, payload = line[:1], line[1:-2].decode()
+    if kind == b"+":
+        return payload
+    if kind == b"-":
+        return RedisError(payload)
+    if kind == b":":
+        return int(payload)
+    if kind == b"$":
+        length = int(payload)
+        if length == -1:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2].decode()
+    if kind == b"*":
+        length = int(payload)
+        if length == -1:
+            return None
+        return [await _read_reply(reader) for _ in range(length)]
+    raise RedisError(f"Неизвестный ответ RESP: {line!r}")
+
+
+def create_storage(url: str) -> StateStorage:
+    # memory:// | sqlite:///path/to/state.db | redis://[:password@]host:port/db
+    parsed = urlparse(url)
+    if parsed.scheme in ("", "memory"):
+        return MemoryStorage()
+    if parsed.scheme == "sqlite":
+        # sqlite:///state.db — относительный путь, sqlite:////var/lib/carbot/state.db — абсолютный
+        path = unquote(parsed.netloc + parsed.path)
+        return SQLiteStorage(path[1:] if path.startswith("/") else path or "state.db")
+    if parsed.scheme == "redis":
+        return RedisStorage(
+            host=parsed.hostname or "localhost",
+            port=parsed.port or 6379,
+            db=int(parsed.path.lstrip("/") or 0),
+            password=unquote(parsed.password) if parsed.password else None,
+        )
+    raise ValueError(f"❌ Неизвестный тип хранилища состояний: {url}")
@@ -0,0 +1,109 @@
+import logging
+import time
+import uuid
+
+from aiogram.types import Message
+
+from locks import KeyedLock
+from outbound import OutboundQueue, PRIORITY_NOTIFY
+from relay import relay_methods
+from scheduler import DeadlineScheduler
+from storage import StateStorage
+
+# Пространства имён в хранилище
+SUPPORT_TICKETS = "support_ticket"
+SUPPORT_THREADS = "support_thread"
+
+# Сколько секунд хранить обращение и связь его сообщений с пользователем
+SUPPORT_TICKET_TTL = 7 * 86400.0
+
+
+class SupportDesk:
+    # Очередь обращений в поддержку поверх StateStorage.
+    # support_ticket: {ticket_id: {"user_id": ..., "username": ..., "status": "open" | "answered", "created": ..., "threads": [...]}}
+    # support_thread: {"chat_id:message_id": {"ticket_id": ...}} — сообщения бота по обращению в чате админа и пользователя.
+    # Ответ (reply) на такое сообщение уходит другой стороне, так переписка по обращению идёт в обе стороны.
+    def __init__(self, storage: StateStorage, outbound: OutboundQueue, scheduler: DeadlineScheduler, admin_id: int, ttl: float = SUPPORT_TICKET_TTL):
+        self.storage = storage
+        self.outbound = outbound
+        self.scheduler = scheduler
+        self.admin_id = admin_id
+        self.ttl = ttl
+        # Админ и пользователь могут ответить по одному обращению одновременно: список нитей дописывается под замком
+        self._locks = KeyedLock()
+
+    async def open_ticket(self, message: Message) -> str:
+        user = message.from_user
+        ticket_id = uuid.uuid4().hex[:8]
+        ticket = {"user_id": user.id, "username": user.username, "status": "open", "created": time.time(), "threads": []}
+        header = (
+            f"📬 Обращение #{ticket_id}\nОт: @{user.username or user.id}\nID: {user.id}\n"
+            "Ответьте на это сообщение (reply), чтобы ответить пользователю."
+        )
+        await self._deliver(ticket_id, ticket, message, self.admin_id, header)
+        self._schedule_expiry(ticket_id, ticket)
+        return ticket_id
+
+    async def find_thread(self, chat_id: int, message_id: int):
+        # (ticket_id, ticket), если сообщение отправлено ботом по обращению
+        thread = await self.storage.get(SUPPORT_THREADS, _thread_key(chat_id, message_id))
+        if thread is None:
+            return None
+        ticket = await self.storage.get(SUPPORT_TICKETS, thread["ticket_id"])
+        return (thread["ticket_id"], ticket) if ticket is not None else None
+
+    async def reply(self, message: Message, ticket_id: str, ticket: dict, album: list = None) -> int:
+        # Пересылает ответ другой стороне обращения и возвращает chat_id получателя
+        if message.chat.id == self.admin_id:
+            chat_id, status = ticket["user_id"], "answered"
+            header = f"💬 Ответ поддержки по обращению #{ticket_id}:\nЧтобы ответить, используйте reply на это сообщение."
+        else:
+            chat_id, status = self.admin_id, "open"
+            header = f"📨 Обращение #{ticket_id}, @{ticket['username'] or ticket['user_id']} (ID: {ticket['user_id']}):"
+        await self._deliver(ticket_id, {**ticket, "status": status}, message, chat_id, header, album)
+        return chat_id
+
+    async def open_tickets(self) -> list:
+        # Обращения без ответа, старые первыми
+        tickets = [(key, ticket) for key, ticket in await self.storage.items(SUPPORT_TICKETS) if ticket["status"] == "open"]
+        return sorted(tickets, key=lambda item: item[1]["created"])
+
+    async def restore(self):
+        # Таймеры удаления обращений после перезапуска
+        for ticket_id, ticket in await self.storage.items(SUPPORT_TICKETS):
+            self._schedule_expiry(ticket_id, ticket)
+
+    async def _deliver(self, ticket_id: str, ticket: dict, message: Message, chat_id: int, header: str, album: list = None):
+        sent = []
+        for method in relay_methods(message, chat_id, header, album=album):
+            sent += _message_ids(await self.outbound.send(method, PRIORITY_NOTIFY))
+        threads = [_thread_key(chat_id, message_id) for message_id in sent]
+        async with self._locks.hold(ticket_id):
+            stored = await self.storage.get(SUPPORT_TICKETS, ticket_id)
+            changes = {(SUPPORT_THREADS, key): {"ticket_id": ticket_id} for key in threads}
+            changes[(SUPPORT_TICKETS, ticket_id)] = {**ticket, "threads": (stored or ticket)["threads"] + threads}
+            await self.storage.apply(changes)
+
+    def _schedule_expiry(self, ticket_id: str, ticket: dict):
+        self.scheduler.schedule(("support", ticket_id), ticket["created"] + self.ttl, self._expire, ticket_id)
+
+    async def _expire(self, ticket_id: str):
+        ticket = await self.storage.get(SUPPORT_TICKETS, ticket_id)
+        if ticket is None:
+            return
+        changes = {(SUPPORT_THREADS, key): None for key in ticket["threads"]}
+        changes[(SUPPORT_TICKETS, ticket_id)] = None
+        await self.storage.apply(changes)
+        logging.info("Обращение #%s удалено по сроку хранения.", ticket_id, extra={"user_id": ticket["user_id"]})
+
+
+def _thread_key(chat_id: int, message_id: int) -> str:
+    return f"{chat_id}:{message_id}"
+
+
+def _message_ids(result) -> list:
+    # sendMessage возвращает Message, copyMessage — MessageId, sendMediaGroup — список Message
+    if isinstance(result, list):
+        return [item.message_id for item in result]
+    message_id = getattr(result, "message_id", None)
+    return [message_id] if message_id is not None else []
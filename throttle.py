@@ -0,0 +1,97 @@
+import math
+import time
+from collections import Counter
+
+from scheduler import DeadlineScheduler
+from storage import StateStorage
+
+# Пространство имён в хранилище: счётчики по "user_id:action"
+THROTTLE = "throttle"
+
+
+def parse_limit(value: str):
+    # "10/60" — не больше 10 действий за 60 секунд
+    count, window = value.split("/")
+    return int(count), float(window)
+
+
+# Лимиты на пользователя: поиск номера, запрос в Himera (платный) и начало диалога
+THROTTLE_SEARCH = "10/60"
+THROTTLE_HIMERA = "5/3600"
+THROTTLE_DIALOG_START = "5/600"
+THROTTLE_LIMITS = {
+    "search": parse_limit(THROTTLE_SEARCH),
+    "himera": parse_limit(THROTTLE_HIMERA),
+    "dialog_start": parse_limit(THROTTLE_DIALOG_START),
+}
+
+
+class SlidingWindowLimiter:
+    # Скользящее окно по двум счётчикам: текущее окно и предыдущее, взятое с весом оставшейся
+    # в окне доли. Запись на пользователя и действие — три числа, а не список меток времени.
+    # Счётчики лежат в том же хранилище, что и сессии, поэтому переживают перезапуск (sqlite, redis).
+    # Запись, которую не трогали два окна, удаляется таймером: её счётчики уже ни на что не влияют.
+    # Вызывающий код держит замок пользователя (UserSerializationMiddleware), поэтому чтение и запись не пересекаются
+    def __init__(self, storage: StateStorage, scheduler: DeadlineScheduler, limits: dict = None):
+        self.storage = storage
+        self.scheduler = scheduler
+        self.limits = dict(THROTTLE_LIMITS if limits is None else limits)
+        self.allowed = Counter()
+        self.rejected = Counter()
+
+    async def hit(self, user_id: int, action: str) -> float:
+        # Засчитывает действие. 0 — разрешено, иначе через сколько секунд можно повторить
+        limit, window = self.limits[action]
+        key = f"{user_id}:{action}"
+        now = time.time()
+        index = int(now // window) # Номер окна: целое, чтобы соседние окна сравнивались точно
+        record = await self.storage.get(THROTTLE, key)
+        previous, current = _counters(record, index)
+        elapsed = now - index * window
+        if previous * (1 - elapsed / window) + current + 1 > limit:
+            self.rejected[action] += 1
+            return _retry_after(previous, current, limit, elapsed, window)
+        await self.storage.set(THROTTLE, key, {"window": index, "previous": previous, "current": current + 1})
+        self._schedule_expiry(key, index, window)
+        self.allowed[action] += 1
+        return 0
+
+    async def restore(self):
+        # Таймеры удаления записей после перезапуска
+        for key, record in await self.storage.items(THROTTLE):
+            action = str(key).rsplit(":", 1)[1]
+            if action in self.limits:
+                self._schedule_expiry(key, record["window"], self.limits[action][1])
+            else:
+                await self.storage.delete(THROTTLE, key) # Лимит убрали из настроек
+
+    def _schedule_expiry(self, key: str, index: int, window: float):
+        self.scheduler.schedule((THROTTLE, key), (index + 2) * window, self._expire, key)
+
+    async def _expire(self, key: str):
+        await self.storage.delete(THROTTLE, key)
+
+    def stats(self):
+        return {action: {"allowed": self.allowed[action], "rejected": self.rejected[action]} for action in self.limits}
+
+
+def _counters(record, index: int):
+    # (предыдущее окно, текущее окно) относительно окна с номером index
+    if record is None:
+        return 0, 0
+    if record["window"] == index:
+        return record["previous"], record["current"]
+    if record["window"] == index - 1:
+        return record["current"], 0
+    return 0, 0
+
+
+def _retry_after(previous: int, current: int, limit: int, elapsed: float, window: float) -> float:
+    free = limit - 1 - current # Сколько ещё действий поместится в текущее окно без учёта предыдущего
+    if free >= 0 and previous:
+        # Место освободится, когда вес предыдущего окна упадёт до free
+        wait = window * (1 - free / previous) - elapsed
+    else:
+        # В текущем окне места нет: в следующем его действия станут предыдущим окном со своим весом
+        wait = window - elapsed + window * max(0, 1 - (limit - 1) / current)
+    return max(1, math.ceil(wait))
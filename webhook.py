@@ -0,0 +1,47 @@
+import asyncio
+import logging
+import signal
+from contextlib import suppress
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, base_url: str, path: str, secret_token: str, host: str, port: int):
+    # Запуск бота в режиме webhook на aiohttp. Хуки dp.startup/dp.shutdown вызываются так же, как при polling
+    if not secret_token:
+        raise ValueError("❌ Для режима webhook нужно задать WEBHOOK_SECRET")
+
+    app = web.Application()
+    # Порядок важен: сначала shutdown диспетчера (дожидается обработчиков и досылает очередь),
+    # и только потом обработчик запросов закрывает HTTP-сессию бота
+    setup_application(app, dp, bot=bot)
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret_token).register(app, path=path)
+
+    async def set_webhook(_: web.Application):
+        await bot.set_webhook(
+            f"{base_url.rstrip('/')}{path}",
+            secret_token=secret_token,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        logging.info("Webhook установлен: %s%s", base_url.rstrip("/"), path)
+
+    app.on_startup.append(set_webhook)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    logging.info("Webhook-сервер слушает %s:%s%s", host, port, path)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    with suppress(NotImplementedError): # Сигналы не поддерживаются на Windows
+        loop.add_signal_handler(signal.SIGTERM, stop.set)
+        loop.add_signal_handler(signal.SIGINT, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        logging.info("Останавливаем webhook-сервер.")
+        await runner.cleanup()
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+from contextlib import suppress
+
+from plates import normalize_plate
+from repository import UsersRepository
+
+# Записи из Himera пишутся в Supabase отложенно, пачками: поиск не ждёт записи
+HIMERA_WRITE_INTERVAL = 2.0
+HIMERA_WRITE_BATCH_SIZE = 100
+HIMERA_WRITE_MAX_ATTEMPTS = 5
+
+
+class UpsertBatcher:
+    # Копит строки по каноническому номеру (повторная запись того же номера заменяет предыдущую)
+    # и сбрасывает их одной пачкой (UsersRepository.upsert_many) раз в интервал или по заполнении пачки.
+    # Неудачная пачка возвращается в очередь и повторяется в следующий сброс.
+    def __init__(
+        self,
+        repo: UsersRepository,
+        interval: float = HIMERA_WRITE_INTERVAL,
+        batch_size: int = HIMERA_WRITE_BATCH_SIZE,
+        max_attempts: int = HIMERA_WRITE_MAX_ATTEMPTS,
+    ):
+        self.repo = repo
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.written = 0
+        self.deduplicated = 0
+        self.failed_batches = 0
+        self.dropped = 0
+        self._pending = {}
+        self._attempts = {}
+        self._wakeup = asyncio.Event()
+        self._closing = False
+        self._task = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, row: dict):
+        plate = normalize_plate(row.get("car_number") or "")
+        if not plate:
+            return
+        if plate in self._pending:
+            self.deduplicated += 1
+        self._pending[plate] = row
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._closing = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Последний сброс делает сам цикл, чтобы не оборвать пачку, которая уже пишется
+        if self._task is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+        if self._pending:
+            logging.warning("Не записаны в Supabase записи из Himera: %s", len(self._pending))
+
+    async def _run(self):
+        while not self._closing:
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            self._wakeup.clear()
+            await self.flush()
+        await self.flush()
+
+    async def flush(self):
+        while self._pending:
+            plates = list(self._pending)[:self.batch_size]
+            batch = {plate: self._pending.pop(plate) for plate in plates}
+            try:
+                await self.repo.upsert_many(list(batch.values()))
+            except Exception as e:
+                self.failed_batches += 1
+                logging.error("Ошибка пакетной записи %s записей из Himera: %s", len(batch), e)
+                self._requeue(batch)
+                return
+            self.written += len(batch)
+            for plate in batch:
+                self._attempts.pop(plate, None)
+
+    def _requeue(self, batch: dict):
+        for plate, row in batch.items():
+            attempts = self._attempts.get(plate, 0) + 1
+            if attempts >= self.max_attempts:
+                self._attempts.pop(plate, None)
+                self.dropped += 1
+                logging.error("Запись номера %s из Himera отброшена после %s попыток.", plate, attempts)
+                continue
+            self._attempts[plate] = attempts
+            # Более свежая запись того же номера, добавленная во время сброса, важнее
+            self._pending.setdefault(plate, row)
+
+    def stats(self):
+        return {
+            "pending": len(self._pending),
+            "written": self.written,
+            "deduplicated": self.deduplicated,
+            "failed_batches": self.failed_batches,
+            "dropped": self.dropped,
+        }